@@ -1,3 +1,220 @@
+import operator
+from functools import reduce
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db.models import Count, Max, Min, Q
+from django.utils.functional import cached_property
+from django.utils.text import smart_split, unescape_string_literal
+
+from duo.models import (
+    User, Group, Phone, Token, SyncRun, ChangeEvent, AuthLog
+)
+from duo.summary import get_summary
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that avoids a COUNT(*) over a whole table.
+
+    Unfiltered changelists use the table totals recorded by the last
+    sync.  Tables the summary has no total for, the append only change
+    feed and authentication log, are estimated from the span of their
+    pks, which pruning the oldest rows keeps close to the row count.
+    Filtered changelists still count, but only the rows matching the
+    filter.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if queryset.query.where:
+            return super(EstimatedCountPaginator, self).count
+
+        model = queryset.model
+        totals = get_summary().get('totals', {})
+        estimate = totals.get(model._meta.verbose_name_plural)
+        if estimate is None:
+            # MIN and MAX of the pk are single index lookups
+            span = model.objects.aggregate(Min('pk'), Max('pk'))
+            estimate = (span['pk__max'] - span['pk__min'] + 1
+                        if span['pk__max'] is not None else 0)
+        return estimate
+
+
+def prefix_upper(term):
+    # Lowest string above every string starting with term
+    return term[:-1] + chr(ord(term[-1]) + 1)
+
+
+class DuoModelAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 100
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search so that each term is answered from an index.
+
+        Django compiles '^field' and '=field' to a case insensitive
+        LIKE, which SQLite answers by scanning the table.  Here '^field'
+        is a case sensitive prefix range and '=field' an exact match,
+        both answered from the index on the field, so every search
+        field must be indexed, and search_help_text says so under the
+        search box.  The matching pks are selected in a subquery, so
+        changelists grouping rows for a count still look them up by pk
+        instead of scanning in pk order.
+        """
+        terms = [
+            unescape_string_literal(term)
+            if term[0] in ('"', "'") and term[-1] == term[0] else term
+            for term in smart_split(search_term)
+        ]
+        terms = [term for term in terms if term]
+        if not terms or not self.get_search_fields(request):
+            return queryset, False
+
+        matching = self.model._default_manager.all()
+        for term in terms:
+            matches = []
+            for field in self.get_search_fields(request):
+                if field.startswith('^'):
+                    matches.append(Q(**{
+                        field[1:] + '__gte': term,
+                        field[1:] + '__lt': prefix_upper(term),
+                    }))
+                elif field.startswith('='):
+                    matches.append(Q(**{field[1:]: term}))
+                else:
+                    raise ValueError(
+                        'Search field %s is neither ^ nor =' % field
+                    )
+            matching = matching.filter(reduce(operator.or_, matches))
+
+        return queryset.filter(pk__in=matching.values('pk')), False
+
+    def search_help_text(self, request):
+        """Describe the search, shown under the changelist search box.
+
+        :return: help text, None without search fields
+        """
+        names = {'^': [], '=': []}
+        for field in self.get_search_fields(request):
+            names[field[0]].append(
+                self.model._meta.get_field(field[1:]).verbose_name
+            )
+
+        matches = []
+        if names['^']:
+            matches.append('%s starting with' % ' or '.join(names['^']))
+        if names['=']:
+            matches.append('%s equal to' % ' or '.join(names['=']))
+        if not matches:
+            return None
+        return 'Case sensitive, matches the %s each term.' % (
+            ', or '.join(matches)
+        )
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = dict(extra_context or {},
+                             search_help_text=self.search_help_text(request))
+        return super(DuoModelAdmin, self).changelist_view(
+            request, extra_context
+        )
+
+
+@admin.register(User)
+class UserAdmin(DuoModelAdmin):
+    list_display = ('username', 'realname', 'email', 'status', 'last_login')
+    # Filtered through the leading column of duo_user_status_login_idx
+    list_filter = ('status',)
+    search_fields = ('^username', '^email', '=user_id')
+
+
+@admin.register(Group)
+class GroupAdmin(DuoModelAdmin):
+    list_display = ('name', 'desc', 'status', 'user_count')
+    list_filter = ('status',)
+    search_fields = ('^name', '=group_id')
+    raw_id_fields = ('users',)
+
+    def get_queryset(self, request):
+        return super(GroupAdmin, self).get_queryset(request).annotate(
+            user_count=Count('users')
+        )
+
+    def user_count(self, obj):
+        return obj.user_count
+    user_count.admin_order_field = 'user_count'
+
+
+@admin.register(Phone)
+class PhoneAdmin(DuoModelAdmin):
+    list_display = ('number', 'name', 'platform', 'type', 'activated',
+                    'user_count')
+    list_filter = ('platform', 'type')
+    search_fields = ('^number', '=e164', '=phone_id')
+    autocomplete_fields = ('users',)
+
+    def get_queryset(self, request):
+        return super(PhoneAdmin, self).get_queryset(request).annotate(
+            user_count=Count('users')
+        )
+
+    def user_count(self, obj):
+        return obj.user_count
+    user_count.admin_order_field = 'user_count'
+
+
+@admin.register(Token)
+class TokenAdmin(DuoModelAdmin):
+    list_display = ('serial', 'token_id', 'type', 'user_count')
+    list_filter = ('type',)
+    search_fields = ('^serial',)
+    autocomplete_fields = ('users',)
+
+    def get_queryset(self, request):
+        return super(TokenAdmin, self).get_queryset(request).annotate(
+            user_count=Count('users')
+        )
+
+    def user_count(self, obj):
+        return obj.user_count
+    user_count.admin_order_field = 'user_count'
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'command', 'started', 'finished', 'success')
+    list_filter = ('command', 'success')
+    readonly_fields = ('command', 'started', 'finished', 'success',
+                       'metrics')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ChangeEvent)
+class ChangeEventAdmin(DuoModelAdmin):
+    list_display = ('pk', 'generation', 'created', 'kind', 'username',
+                    'object_id', 'old_value', 'new_value')
+    # No search_fields, neither user_id nor username is indexed
+    list_filter = ('kind',)
+    readonly_fields = ('generation', 'created', 'kind', 'user_id',
+                       'username', 'object_id', 'old_value', 'new_value')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(AuthLog)
+class AuthLogAdmin(DuoModelAdmin):
+    list_display = ('timestamp', 'username', 'factor', 'result', 'reason',
+                    'application', 'ip', 'device')
+    # No list_filter, listing the distinct values would scan the log
+    search_fields = ('^username', '=txid')
+    readonly_fields = ('txid', 'timestamp', 'user_id', 'username',
+                       'event_type', 'factor', 'result', 'reason',
+                       'application', 'ip', 'city', 'state', 'country',
+                       'device')
 
-# Register your models here.
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,523 @@
+import http.client
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import duo_client
+from django.conf import settings
+
+
+# Maximum page sizes accepted by the Admin API endpoints
+USERS_PAGE_SIZE = 300
+GROUPS_PAGE_SIZE = 100
+PHONES_PAGE_SIZE = 500
+TOKENS_PAGE_SIZE = 500
+AUTHLOGS_PAGE_SIZE = 1000
+
+# Authentication log endpoint, paged by timestamp and transaction id
+AUTHLOGS_PATH = '/admin/v2/logs/authentication'
+
+# Paged endpoints fetched for a full sync, as name -> (path, page size)
+ENDPOINTS = {
+    'groups': ('/admin/v1/groups', GROUPS_PAGE_SIZE),
+    'users': ('/admin/v1/users', USERS_PAGE_SIZE),
+    'phones': ('/admin/v1/phones', PHONES_PAGE_SIZE),
+    'tokens': ('/admin/v1/tokens', TOKENS_PAGE_SIZE),
+}
+
+# Default number of concurrent Admin API requests
+FETCH_WORKERS = 4
+
+# Rate limited (429) and transient server error responses worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Idle keep-alive connections kept per client, and for how many seconds
+POOL_SIZE = 8
+POOL_IDLE_TIMEOUT = 60.0
+
+
+class ConnectionPool(object):
+    """Thread safe pool of idle keep-alive HTTP(S) connections.
+
+    Connections are handed out most recently used first.  Connections
+    idle for longer than idle_timeout are closed rather than reused,
+    since the server has most likely dropped them already.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT):
+        """
+        :param connect: callable returning a new, unconnected connection
+        :param size: largest number of idle connections kept
+        :param idle_timeout: seconds an idle connection may be reused for
+        """
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return an idle connection, or a new one if there is none.
+
+        :return: tuple of (connection, whether it was reused)
+        """
+        expired = []
+
+        with self._lock:
+            conn = None
+            while self._idle and conn is None:
+                conn, used = self._idle.pop()
+                if time.time() - used > self.idle_timeout:
+                    expired.append(conn)
+                    conn = None
+            self.discarded += len(expired)
+            if conn is not None:
+                self.reused += 1
+            else:
+                self.opened += 1
+
+        for old in expired:
+            old.close()
+
+        if conn is not None:
+            return conn, True
+        return self.connect(), False
+
+    def put(self, conn):
+        """Return a connection to the pool once its response is read."""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        """Close a connection that can't be reused."""
+        with self._lock:
+            self.discarded += 1
+        conn.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, used in idle:
+            conn.close()
+
+    def stats(self):
+        """Return the connection reuse counters."""
+        with self._lock:
+            return {
+                'opened': self.opened,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': len(self._idle),
+            }
+
+
+class AdaptiveLimiter(object):
+    """Bound the number of concurrent API requests, AIMD style.
+
+    The limit grows by one for every limit successful requests and is
+    halved on every rate limited response, settling just below the
+    rate limit of the tenant.
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: largest number of concurrent requests
+        """
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class Admin(duo_client.Admin):
+    """duo_client.Admin retrying rate limited and failed requests.
+
+    Requests answered with one of RETRY_STATUSES, or failing at the
+    connection level, are retried with jittered exponential backoff so
+    a single page rather than the whole run is repeated.
+
+    Connections are kept alive in a ConnectionPool shared by every
+    request made through the instance, including from several threads.
+
+    Set the metrics attribute to a duo.instrumentation.SyncMetrics to
+    record the count, latency and retries of every request per endpoint,
+    and the limiter attribute to an AdaptiveLimiter to share concurrency
+    between threads.
+    """
+
+    metrics = None
+    limiter = None
+
+    # Retries per request, and the backoff cap and base in seconds
+    max_retries = 6
+    backoff_base = 0.5
+    backoff_max = 30.0
+
+    def __init__(self, *args, pool_size=POOL_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT, **kwargs):
+        super(Admin, self).__init__(*args, **kwargs)
+
+        self.pool = ConnectionPool(self._connect, pool_size, idle_timeout)
+
+    def api_call(self, method, path, params):
+        attempt = 0
+
+        while True:
+            try:
+                (response, data) = self._timed_api_call(method, path, params)
+            except (OSError, http.client.HTTPException):
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                if (response.status not in RETRY_STATUSES or
+                        attempt >= self.max_retries):
+                    return response, data
+
+            throttled = response is not None and response.status == 429
+            if self.metrics is not None:
+                self.metrics.observe_retry(path, throttled)
+
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+
+    def _timed_api_call(self, method, path, params):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+        start = time.time()
+        status = None
+        try:
+            (response, data) = super(Admin, self).api_call(
+                method, path, params
+            )
+            status = response.status
+            return response, data
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(throttled=status == 429)
+            if self.metrics is not None:
+                self.metrics.observe_request(
+                    path, time.time() - start, status
+                )
+
+    def _make_request(self, method, uri, body, headers):
+        if self.proxy_type == 'CONNECT':
+            # Ensure the request uses the correct protocol and Host.
+            if self.ca_certs == 'HTTP':
+                api_proto = 'http'
+            else:
+                api_proto = 'https'
+            uri = ''.join((api_proto, '://', self.host, uri))
+
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                conn.request(method, uri, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                self.pool.discard(conn)
+                # The server may have closed the idle connection already
+                if reused and method == 'GET':
+                    continue
+                raise
+
+            if response.will_close:
+                self.pool.discard(conn)
+            else:
+                self.pool.put(conn)
+
+            return response, data
+
+    def backoff(self, attempt, response=None):
+        """Return the number of seconds to wait before a retry.
+
+        Uses full jitter exponential backoff, but never less than a
+        Retry-After header sent by the API.
+
+        :param attempt: number of retries made so far
+        :param response: failed HTTP response, None for connection errors
+        :return: seconds to sleep
+        """
+        delay = random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        )
+
+        retry_after = response and response.getheader('Retry-After')
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+
+        return delay
+
+
+def get_admin_api():
+    """Create the Duo Admin API Client Object from the project settings.
+
+    DUO_HOST may carry a port (host:port) and DUO_CA_CERTS is passed on
+    to duo_client, e.g. 'HTTP' to talk to a local fake_duo_api server.
+    DUO_API_TIMEOUT, DUO_API_POOL_SIZE and DUO_API_IDLE_TIMEOUT set the
+    per-request timeout and the keep-alive connection pool.
+
+    :return: Admin instance
+    """
+    host, _, port = (settings.DUO_HOST or '').partition(':')
+
+    admin_api = Admin(
+        settings.DUO_IKEY, settings.DUO_SKEY, host,
+        ca_certs=settings.DUO_CA_CERTS or None,
+        timeout=settings.DUO_API_TIMEOUT,
+        pool_size=settings.DUO_API_POOL_SIZE,
+        idle_timeout=settings.DUO_API_IDLE_TIMEOUT
+    )
+    if port:
+        admin_api.port = int(port)
+
+    return admin_api
+
+
+def json_paging_api_call(admin_api, path, params):
+    """Call a paged Admin API endpoint and keep the paging metadata.
+
+    duo_client's json_api_call only returns the 'response' member of the
+    body, which drops the metadata needed to walk the result set.
+
+    :param admin_api: duo_client.Admin instance
+    :param path: endpoint path, e.g. /admin/v1/users
+    :param params: query parameters, including limit and offset
+    :return: tuple of (response list, metadata dictionary)
+    :raises RuntimeError: on any API error
+    """
+    (response, data) = admin_api.api_call('GET', path, params)
+
+    try:
+        if not isinstance(data, str):
+            body = json.loads(data.decode('utf-8'))
+        else:
+            body = json.loads(data)
+        if response.status == 200 and body['stat'] == 'OK':
+            return body['response'], body.get('metadata', {})
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    # Let duo_client raise the usual RuntimeError for the failed call
+    return admin_api.parse_json_response(response, data), {}
+
+
+def iter_pages(admin_api, path, limit, params=None):
+    """Yield an Admin API result set one page at a time.
+
+    Only a single page is held in memory, so peak memory depends on
+    the page size rather than the size of the tenant.
+
+    :param admin_api: duo_client.Admin instance
+    :param path: endpoint path, e.g. /admin/v1/users
+    :param limit: number of objects requested per page
+    :param params: additional query parameters
+    :return: generator of lists of API objects
+    :raises RuntimeError: on any API error
+    """
+    offset = 0
+
+    while offset is not None:
+        page_params = dict(params or {}, limit=str(limit), offset=str(offset))
+        page, metadata = json_paging_api_call(admin_api, path, page_params)
+
+        if page:
+            yield page
+
+        offset = metadata.get('next_offset')
+
+
+def iter_authlogs(admin_api, mintime, maxtime, limit=AUTHLOGS_PAGE_SIZE):
+    """Yield authentication log events one page at a time, oldest first.
+
+    :param admin_api: duo_client.Admin instance
+    :param mintime: Unix timestamp in ms of the first event, inclusive
+    :param maxtime: Unix timestamp in ms of the last event, inclusive
+    :param limit: number of events requested per page
+    :return: generator of lists of API authentication log events
+    :raises RuntimeError: on any API error
+    """
+    params = {
+        'mintime': str(mintime),
+        'maxtime': str(maxtime),
+        'limit': str(limit),
+        'sort': 'ts:asc',
+    }
+
+    while True:
+        response, metadata = json_paging_api_call(
+            admin_api, AUTHLOGS_PATH, params
+        )
+
+        if response['authlogs']:
+            yield response['authlogs']
+
+        # The next page starts after a (timestamp, txid) pair
+        next_offset = response.get('metadata', {}).get('next_offset')
+        if not next_offset:
+            return
+        params['next_offset'] = ','.join(str(value) for value in next_offset)
+
+
+class ConcurrentFetcher(object):
+    """Fetch several paged Admin API endpoints in a bounded thread pool.
+
+    Each endpoint's first page is requested straight away.  Once its
+    total_objects is known the remaining pages are requested in parallel,
+    so the overall fetch time is set by the slowest endpoint.  Pages are
+    handed to the (single threaded) consumer through a bounded queue.
+    """
+
+    # Marks the end of an endpoint on the results queue
+    DONE = object()
+
+    def __init__(self, endpoints, max_workers=FETCH_WORKERS,
+                 client_factory=get_admin_api):
+        """
+        :param endpoints: dictionary of name -> (path, page size)
+        :param max_workers: number of concurrent API requests
+        :param client_factory: callable returning a duo_client.Admin
+        """
+        self.endpoints = endpoints
+        self.max_workers = max_workers
+        self.client_factory = client_factory
+        self.results = queue.Queue(maxsize=max_workers * 2)
+        self.limiter = AdaptiveLimiter(max_workers)
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stop = threading.Event()
+
+    def _client(self):
+        # Each thread asks the factory once.  It may build a client per
+        # thread, or return one duo.api.Admin shared by every thread as
+        # DuoSync does, which is safe since its connections are pooled
+        if not hasattr(self._local, 'admin_api'):
+            admin_api = self.client_factory()
+            admin_api.limiter = self.limiter
+            with self._lock:
+                self._clients.append(admin_api)
+            self._local.admin_api = admin_api
+        return self._local.admin_api
+
+    def _fetch_page(self, name, offset):
+        path, limit = self.endpoints[name]
+        return json_paging_api_call(
+            self._client(), path, {'limit': str(limit), 'offset': str(offset)}
+        )
+
+    def _page_done(self, name):
+        with self._lock:
+            self._pending[name] -= 1
+            finished = not self._pending[name]
+        if finished:
+            self.results.put((name, self.DONE))
+
+    def _fetch_rest(self, name, offset):
+        # Skip pages queued before the consumer gave up
+        if not self._stop.is_set():
+            try:
+                page, metadata = self._fetch_page(name, offset)
+                self.results.put((name, page))
+            except Exception as e:
+                self.results.put((name, e))
+        self._page_done(name)
+
+    def _fetch_first(self, executor, name):
+        try:
+            page, metadata = self._fetch_page(name, 0)
+            self.results.put((name, page))
+
+            next_offset = metadata.get('next_offset')
+            total = metadata.get('total_objects')
+
+            if next_offset is not None and total is not None:
+                # Split the rest of the result set across the pool
+                limit = self.endpoints[name][1]
+                offsets = range(int(next_offset), int(total), limit)
+                with self._lock:
+                    self._pending[name] += len(offsets)
+                for offset in offsets:
+                    executor.submit(self._fetch_rest, name, offset)
+            else:
+                # No total to split on, walk the pages in this worker
+                while next_offset is not None and not self._stop.is_set():
+                    page, metadata = self._fetch_page(name, next_offset)
+                    self.results.put((name, page))
+                    next_offset = metadata.get('next_offset')
+        except Exception as e:
+            self.results.put((name, e))
+        self._page_done(name)
+
+    def pages(self):
+        """Yield (endpoint name, page) tuples as pages arrive.
+
+        Once every page of an endpoint has been yielded a final
+        (name, None) tuple marks the endpoint as complete.
+
+        :return: generator of (name, list of API objects or None)
+        :raises RuntimeError: if any page could not be fetched
+        """
+        remaining = set(self.endpoints)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for name in self.endpoints:
+                    self._pending[name] = 1
+                    executor.submit(self._fetch_first, executor, name)
+
+                try:
+                    while remaining:
+                        name, page = self.results.get()
+                        if page is self.DONE:
+                            remaining.discard(name)
+                            yield name, None
+                        elif isinstance(page, Exception):
+                            raise page
+                        elif page:
+                            yield name, page
+                finally:
+                    # Unblock any workers still waiting on a full queue
+                    self._drain(executor)
+        finally:
+            # Clients may outlive the fetch, e.g. the one a DuoSync
+            # reuses for its single threaded calls and later runs
+            for admin_api in self._clients:
+                admin_api.limiter = None
+
+    def _drain(self, executor):
+        self._stop.set()
+        while any(self._pending.values()) or not self.results.empty():
+            try:
+                self.results.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,158 @@
+import datetime
+import time
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from duo.api import iter_authlogs, AUTHLOGS_PAGE_SIZE
+from duo.models import AuthLog, Checkpoint
+
+
+# Number of rows written per executemany call
+BATCH_SIZE = 1000
+
+CHECKPOINT = 'authlogs'
+
+# Duo may take up to two minutes to make an event available, so the
+# newest two minutes are left for the next fetch
+AUTHLOG_DELAY = 120
+
+# Days of history read by the first fetch
+INITIAL_DAYS = 1
+
+
+def normalize_authlog(event):
+    """Build the local AuthLog field dictionary for a Duo API event.
+
+    :param event: v2 authentication log event
+    :return: dictionary of AuthLog model fields
+    """
+    user = event.get('user') or {}
+    application = event.get('application') or {}
+    access_device = event.get('access_device') or {}
+    location = access_device.get('location') or {}
+    auth_device = event.get('auth_device') or {}
+
+    return {
+        'txid': event['txid'],
+        'timestamp': datetime.datetime.fromtimestamp(
+            event['timestamp'], tz=pytz.utc
+        ),
+        'user_id': user.get('key'),
+        'username': user.get('name'),
+        'event_type': event.get('event_type'),
+        'factor': event.get('factor'),
+        'result': event.get('result'),
+        'reason': event.get('reason'),
+        'application': application.get('name'),
+        'ip': access_device.get('ip'),
+        'city': location.get('city'),
+        'state': location.get('state'),
+        'country': location.get('country'),
+        'device': auth_device.get('name'),
+    }
+
+
+def store_authlogs(events, batch_size=BATCH_SIZE):
+    """Insert a page of events, skipping those already stored.
+
+    Events are deduplicated on their txid against the rows stored for
+    the page's time range, read with a range scan of the timestamp
+    index.  New rows are written with executemany, skipping the cost
+    of building a model instance and compiling an INSERT per row.
+
+    :param events: list of API authentication log events, oldest first
+    :param batch_size: number of rows per executemany call
+    :return: number of inserted events
+    """
+    records = dict(
+        (record['txid'], record)
+        for record in map(normalize_authlog, events)
+    )
+    if not records:
+        return 0
+
+    timestamps = [record['timestamp'] for record in records.values()]
+    stored = set(AuthLog.objects.filter(
+        timestamp__gte=min(timestamps), timestamp__lte=max(timestamps)
+    ).values_list('txid', flat=True))
+
+    columns = [
+        field.column for field in AuthLog._meta.concrete_fields
+        if not field.primary_key
+    ]
+    adapt = connection.ops.adapt_datetimefield_value
+    rows = []
+    for txid, record in records.items():
+        if txid not in stored:
+            record['timestamp'] = adapt(record['timestamp'])
+            rows.append(tuple(record[column] for column in columns))
+
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(
+                'INSERT INTO %s (%s) VALUES (%s)' % (
+                    AuthLog._meta.db_table, ', '.join(columns),
+                    ', '.join(['%s'] * len(columns))
+                ), rows[i:i + batch_size]
+            )
+    return len(rows)
+
+
+def prune_authlogs(days=None):
+    """Remove the events older than the retention period.
+
+    :param days: retention in days, DUO_AUTHLOG_RETENTION_DAYS by default
+    :return: number of removed events
+    """
+    if days is None:
+        days = settings.DUO_AUTHLOG_RETENTION_DAYS
+
+    # A single range DELETE on the timestamp index, nothing cascades
+    deleted, counts = AuthLog.objects.filter(
+        timestamp__lt=timezone.now() - datetime.timedelta(days=days)
+    ).delete()
+    return deleted
+
+
+def fetch_authlogs(admin_api, initial_days=INITIAL_DAYS,
+                   limit=AUTHLOGS_PAGE_SIZE, now=None):
+    """Fetch the authentication log since the stored checkpoint.
+
+    Each page is stored together with a checkpoint at its newest
+    event, so an interrupted fetch resumes where it stopped.  Events
+    at the checkpoint are read again and skipped as duplicates.
+
+    :param admin_api: duo.api.Admin instance
+    :param initial_days: days of history read when there is no checkpoint
+    :param limit: number of events requested per page
+    :param now: current Unix timestamp, time.time() by default
+    :return: tuple of (fetched events, inserted events)
+    """
+    now = time.time() if now is None else now
+    maxtime = int((now - AUTHLOG_DELAY) * 1000)
+
+    checkpoint = Checkpoint.objects.filter(name=CHECKPOINT).first()
+    if checkpoint is None:
+        checkpoint = Checkpoint(
+            name=CHECKPOINT,
+            mintime=int((now - initial_days * 86400) * 1000)
+        )
+
+    fetched = inserted = 0
+    for page in iter_authlogs(admin_api, checkpoint.mintime, maxtime, limit):
+        with transaction.atomic():
+            inserted += store_authlogs(page)
+            checkpoint.mintime = max(
+                checkpoint.mintime, page[-1]['timestamp'] * 1000
+            )
+            checkpoint.save()
+        fetched += len(page)
+
+    # Everything up to maxtime has been read
+    checkpoint.mintime = max(checkpoint.mintime, maxtime)
+    checkpoint.save()
+
+    return fetched, inserted
@@ -0,0 +1,94 @@
+import hashlib
+from functools import wraps
+
+from django.core.cache import cache
+
+from duo.models import SyncRun
+
+
+# Seconds other processes may keep serving the previous sync generation
+# before they notice a new successful SyncRun
+GENERATION_TTL = 5
+
+LAST_SYNC_KEY = 'duo:last_sync'
+
+
+def last_sync():
+    """Return the last successful SyncRun, None before the first sync.
+
+    The SyncRun is cached for GENERATION_TTL seconds, so serving a
+    cached response doesn't need a database query.  Once it expires
+    the next call queries SyncRun again, one query per GENERATION_TTL
+    per process, which is how a process notices a sync run by another.
+    """
+    sync_run = cache.get(LAST_SYNC_KEY)
+    if sync_run is None:
+        sync_run = SyncRun.objects.filter(
+            success=True
+        ).only('pk', 'finished').order_by('-pk').first()
+        set_last_sync(sync_run)
+
+    # False marks a cached lookup that found no sync
+    return sync_run or None
+
+
+def set_last_sync(sync_run):
+    """Make a successful SyncRun the current sync generation.
+
+    :param sync_run: SyncRun, None if no sync has succeeded yet
+    """
+    cache.set(LAST_SYNC_KEY, sync_run or False, GENERATION_TTL)
+
+
+def sync_generation():
+    """Return the current sync generation, 0 before the first sync.
+
+    The generation is the pk of the last successful SyncRun, so it
+    increases with every successful sync.
+    """
+    sync_run = last_sync()
+    return sync_run.pk if sync_run else 0
+
+
+def generation_key(name):
+    """Build a cache key for a value of the current sync generation.
+
+    Keys of older generations are never read again and are dropped by
+    the cache as it reaches its MAX_ENTRIES bound.
+
+    :param name: name of the cached value, e.g. a request path
+    :return: cache key
+    """
+    return 'duo:%s:%s' % (
+        sync_generation(), hashlib.sha1(name.encode('utf-8')).hexdigest()
+    )
+
+
+def cached(name, compute):
+    """Return a cached value of the current sync generation.
+
+    :param name: name of the cached value
+    :param compute: callable returning the value on a cache miss
+    :return: cached or freshly computed value
+    """
+    key = generation_key(name)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, None)
+    return value
+
+
+def cache_response(view):
+    """Cache successful responses of a view per sync generation and URL."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = generation_key('response:%s' % request.get_full_path())
+        response = cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response, None)
+        return response
+
+    return wrapper
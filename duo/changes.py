@@ -0,0 +1,105 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from duo.cache import sync_generation
+from duo.models import ChangeEvent, Group, Phone, Token, SyncRun
+
+
+# Number of rows written or looked up per statement
+BATCH_SIZE = 500
+
+# Events emitted for added and removed (object, User) pairs, with the
+# model and natural key field of the object, per User association
+LINK_EVENTS = {
+    'groups': (ChangeEvent.GROUP_JOINED, ChangeEvent.GROUP_LEFT,
+               Group, 'group_id'),
+    'phones': (ChangeEvent.PHONE_ADDED, ChangeEvent.PHONE_REMOVED,
+               Phone, 'phone_id'),
+    'tokens': (ChangeEvent.TOKEN_ADDED, ChangeEvent.TOKEN_REMOVED,
+               Token, 'serial'),
+}
+
+
+def emit(events, batch_size=BATCH_SIZE):
+    """Append change events.
+
+    :param events: list of unsaved ChangeEvent instances
+    :param batch_size: number of rows per INSERT statement
+    :return: number of emitted events
+    """
+    ChangeEvent.objects.bulk_create(events, batch_size=batch_size)
+    return len(events)
+
+
+def natural_keys(model, key_field, pks, batch_size=BATCH_SIZE):
+    """Map primary keys to natural keys with batched IN queries.
+
+    :param model: Django model class
+    :param key_field: name of the unique natural key field
+    :param pks: primary keys to look up
+    :param batch_size: maximum number of pks per IN query
+    :return: dictionary of pk -> natural key
+    """
+    pks = sorted(pks)
+    keys = {}
+    for i in range(0, len(pks), batch_size):
+        keys.update(model.objects.filter(
+            pk__in=pks[i:i + batch_size]
+        ).values_list('pk', key_field))
+    return keys
+
+
+def prune_changes(days=None):
+    """Remove the events of generations older than the retention period.
+
+    Whole generations are removed, those of every SyncRun started
+    before the cutoff, with a range delete on the generation index.
+
+    :param days: retention in days, DUO_CHANGE_RETENTION_DAYS by default
+    :return: number of removed events
+    """
+    if days is None:
+        days = settings.DUO_CHANGE_RETENTION_DAYS
+
+    cutoff = SyncRun.objects.filter(
+        started__lt=timezone.now() - datetime.timedelta(days=days)
+    ).aggregate(Max('pk'))['pk__max']
+    if cutoff is None:
+        return 0
+
+    deleted, counts = ChangeEvent.objects.filter(
+        generation__lte=cutoff
+    ).delete()
+    return deleted
+
+
+def changes_since(since=0):
+    """Return the events of the generations after a given one.
+
+    Events of a sync in progress, or of a failed sync not yet followed
+    by a successful one, are left out, so a consumer never reads part
+    of a generation it has already moved past.
+
+    :param since: last generation the consumer has read, 0 for all
+    :return: QuerySet of ChangeEvents ordered by pk
+    """
+    return ChangeEvent.objects.filter(
+        generation__gt=since, generation__lte=sync_generation()
+    ).order_by('pk')
+
+
+def serialize_event(event):
+    return {
+        'id': event.pk,
+        'generation': event.generation,
+        'created': event.created,
+        'kind': event.kind,
+        'user_id': event.user_id,
+        'username': event.username,
+        'object_id': event.object_id,
+        'old_value': event.old_value,
+        'new_value': event.new_value,
+    }
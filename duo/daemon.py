@@ -0,0 +1,266 @@
+import json
+import random
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.db import close_old_connections
+
+from duo.locking import sync_lock, SyncLockHeld
+from duo.sync import DuoSync, SYNC_ERRORS
+
+
+# Default seconds between two runs of each job
+GROUPS_INTERVAL = 3600
+USERS_INTERVAL = 900
+DEVICES_INTERVAL = 3600
+
+# Fraction of the interval each run is moved by at random, so the jobs
+# drift apart instead of hitting the API at the same moments
+JITTER = 0.1
+
+# Seconds before retrying a job that found the sync lock held
+LOCK_RETRY = 60
+
+# A job without a successful run for this many intervals is unhealthy
+STALE_INTERVALS = 3
+
+
+class Job(object):
+    """A sync scheduled every interval seconds, plus or minus jitter."""
+
+    def __init__(self, name, phases, interval, jitter=JITTER):
+        """
+        :param name: job name, e.g. 'users'
+        :param phases: DuoSync phases the job runs
+        :param interval: seconds between two runs
+        :param jitter: fraction of the interval a run is moved by
+        """
+        self.name = name
+        self.phases = phases
+        self.interval = interval
+        self.jitter = jitter
+
+        self.created = time.time()
+        self.next_run = self.created
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_started = None
+        self.last_finished = None
+        self.last_success = None
+        self.last_error = None
+
+    def schedule(self, rng, delay=None):
+        """Schedule the next run.
+
+        :param rng: random.Random instance
+        :param delay: seconds until the next run, a jittered interval
+                      by default
+        """
+        if delay is None:
+            delay = self.interval * (
+                1 + rng.uniform(-self.jitter, self.jitter)
+            )
+        self.next_run = time.time() + delay
+
+    def healthy(self, now):
+        return (self.last_success or self.created) >= (
+            now - STALE_INTERVALS * self.interval
+        )
+
+    def status(self, now):
+        return {
+            'phases': list(self.phases),
+            'interval': self.interval,
+            'running': self.running,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_started': self.last_started,
+            'last_finished': self.last_finished,
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'next_run': self.next_run,
+            'healthy': self.healthy(now),
+        }
+
+
+def default_jobs(groups=GROUPS_INTERVAL, users=USERS_INTERVAL,
+                 devices=DEVICES_INTERVAL, jitter=JITTER):
+    """Build the group, user and device jobs, in the order they run.
+
+    A job with an interval of 0 is left out.
+
+    :return: list of Job instances
+    """
+    jobs = [
+        Job('groups', ('groups', 'search'), groups, jitter),
+        Job('users', ('users', 'memberships', 'stale', 'search'), users,
+            jitter),
+        Job('devices', ('devices',), devices, jitter),
+    ]
+    return [job for job in jobs if job.interval > 0]
+
+
+class SyncDaemon(object):
+    """Run the sync jobs from a single resident process.
+
+    Every run reuses the same API client, so keep-alive connections
+    still within their idle timeout are reused as well.  Runs hold the
+    sync lock, so they never overlap with each other or with a sync
+    started from a management command.
+    """
+
+    def __init__(self, admin_api, command, jobs, sync_options=None,
+                 metrics_file=None, seed=None):
+        """
+        :param admin_api: duo.api.Admin instance shared by every run
+        :param command: management command used for output
+        :param jobs: list of Job instances
+        :param sync_options: keyword arguments passed on to DuoSync
+        :param metrics_file: see DuoSync.finish
+        :param seed: random seed for the jitter
+        """
+        self.admin_api = admin_api
+        self.command = command
+        self.stdout = command.stdout
+        self.style = command.style
+        self.jobs = jobs
+        self.sync_options = sync_options or {}
+        self.metrics_file = metrics_file
+        self.rng = random.Random(seed)
+        self.started = time.time()
+        self.stopping = threading.Event()
+
+    def run_forever(self):
+        """Run due jobs until stop() is called."""
+        while not self.stopping.is_set():
+            for job in self.jobs:
+                if self.stopping.is_set():
+                    break
+                if job.next_run <= time.time():
+                    self.run_job(job)
+
+            next_run = min(job.next_run for job in self.jobs)
+            self.stopping.wait(max(0, next_run - time.time()))
+
+    def stop(self):
+        """Stop once the running job, if any, has finished."""
+        self.stopping.set()
+
+    def run_job(self, job):
+        """Run a job under the sync lock and schedule its next run.
+
+        :param job: Job instance
+        """
+        try:
+            with sync_lock():
+                self.sync(job)
+        except SyncLockHeld as e:
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' %s, retrying the %s job in %ss' % (e, job.name, LOCK_RETRY)
+            )
+            job.schedule(self.rng, LOCK_RETRY)
+            return
+
+        job.schedule(self.rng)
+
+    def sync(self, job):
+        """Run the phases of a job, recording but surviving any error.
+
+        :param job: Job instance
+        """
+        # Connections may have been dropped by the database while idle
+        close_old_connections()
+
+        job.running = True
+        job.runs += 1
+        job.last_started = time.time()
+        self.stdout.write(
+            self.style.WARNING('[-]') + ' Running the %s job' % job.name
+        )
+
+        sync = None
+        try:
+            sync = DuoSync(self.admin_api, self.command, **self.sync_options)
+            sync.run(job.phases)
+            sync.finish(True, self.metrics_file, close=False)
+        except Exception as e:
+            job.failures += 1
+            job.last_error = '%s (%s)' % (e, type(e).__name__)
+            self.stdout.write(self.style.ERROR(
+                '[!] The %s job failed: %s' % (job.name, job.last_error)
+            ))
+            if not isinstance(e, SYNC_ERRORS):
+                self.stdout.write(traceback.format_exc())
+            if sync is not None:
+                try:
+                    sync.finish(False, self.metrics_file, close=False)
+                except Exception:
+                    self.stdout.write(traceback.format_exc())
+        else:
+            job.last_success = time.time()
+            job.last_error = None
+            sync.report()
+        finally:
+            job.running = False
+            job.last_finished = time.time()
+            close_old_connections()
+
+    def healthy(self):
+        now = time.time()
+        return all(job.healthy(now) for job in self.jobs)
+
+    def status(self):
+        now = time.time()
+        return {
+            'healthy': self.healthy(),
+            'started': self.started,
+            'jobs': dict((job.name, job.status(now)) for job in self.jobs),
+        }
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Answer GET /health with the daemon status as JSON.
+
+    The status is read from memory only, never from the database, so
+    the endpoint answers while a sync holds the database.  Unhealthy
+    daemons are answered with a 503.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/health'):
+            return self.reply(404, {'error': 'Not found'})
+
+        daemon = self.server.sync_daemon
+        status = daemon.status()
+        self.reply(200 if status['healthy'] else 503, status)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_health_server(daemon, host='127.0.0.1', port=0):
+    """Serve the health endpoint of a daemon from a background thread.
+
+    :param daemon: SyncDaemon instance
+    :param host: interface to listen on, local only by default
+    :param port: port to listen on, 0 picks a free port
+    :return: ThreadingHTTPServer, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    server.daemon_threads = True
+    server.sync_daemon = daemon
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,136 @@
+import csv
+import io
+import zlib
+from collections import defaultdict
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from duo.models import User, Group, Phone, Token
+
+
+# Number of Users read and written per chunk
+EXPORT_CHUNK_SIZE = 2000
+
+FORMATS = ('csv', 'ndjson')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+USER_FIELDS = ('id', 'user_id', 'username', 'email', 'status', 'realname',
+               'notes', 'last_login')
+
+# Association, through model and the related fields exported per User
+RELATIONS = (
+    ('groups', Group.users.through, ('group__group_id', 'group__name'),
+     ('group_id', 'name')),
+    ('phones', Phone.users.through, ('phone__phone_id', 'phone__number'),
+     ('phone_id', 'number')),
+    ('tokens', Token.users.through, ('token__serial', 'token__type'),
+     ('serial', 'type')),
+)
+
+# Related field joined into each CSV association column
+CSV_COLUMNS = {'groups': 'name', 'phones': 'number', 'tokens': 'serial'}
+
+
+def user_chunks(chunk_size=EXPORT_CHUNK_SIZE):
+    """Walk every User with its groups, phones and tokens in pk order.
+
+    Chunks are selected with pk > last pk, so each costs the same, and
+    span a contiguous pk range.  The associations of a whole chunk are
+    read with one range query per through table on its user cover
+    index, instead of one query per User and association.  Only plain
+    values are loaded, no model instances.
+
+    :param chunk_size: number of Users per chunk
+    :return: generator of lists of User dictionaries
+    """
+    queryset = User.objects.order_by('pk').values(*USER_FIELDS)
+    last = 0
+
+    while True:
+        users = list(queryset.filter(pk__gt=last)[:chunk_size])
+        if not users:
+            return
+        first, last = users[0]['id'], users[-1]['id']
+
+        for name, through, fields, keys in RELATIONS:
+            related = defaultdict(list)
+            for row in through.objects.filter(
+                    user_id__gte=first, user_id__lte=last
+            ).values_list('user_id', *fields).iterator():
+                related[row[0]].append(dict(zip(keys, row[1:])))
+            for user in users:
+                user[name] = related.get(user['id'], [])
+
+        yield users
+
+
+def csv_chunks(chunks):
+    """Render User chunks as CSV, associations joined with semicolons.
+
+    :param chunks: generator of lists of User dictionaries
+    :return: generator of CSV text, one string per chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(USER_FIELDS + tuple(name for name, _, _, _ in RELATIONS))
+    yield buffer.getvalue()
+
+    for users in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        for user in users:
+            writer.writerow(
+                [user[field] for field in USER_FIELDS] +
+                [';'.join(str(item[CSV_COLUMNS[name]]) for item in user[name])
+                 for name, _, _, _ in RELATIONS]
+            )
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(chunks):
+    """Render User chunks as newline delimited JSON, one User per line.
+
+    :param chunks: generator of lists of User dictionaries
+    :return: generator of NDJSON text, one string per chunk
+    """
+    encoder = DjangoJSONEncoder()
+    for users in chunks:
+        yield ''.join(encoder.encode(user) + '\n' for user in users)
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of text chunks into a single gzip stream.
+
+    :param chunks: generator of text
+    :param level: zlib compression level
+    :return: generator of gzip bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_users(format='csv', compress=False,
+                 chunk_size=EXPORT_CHUNK_SIZE):
+    """Stream every User with their groups, phones and tokens.
+
+    Memory stays bounded by a single chunk of Users.
+
+    :param format: 'csv' or 'ndjson'
+    :param compress: gzip the output
+    :param chunk_size: number of Users per chunk
+    :return: generator of text, or of bytes when compressed
+    """
+    if format not in FORMATS:
+        raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+
+    render = csv_chunks if format == 'csv' else ndjson_chunks
+    chunks = render(user_chunks(chunk_size))
+    return gzip_chunks(chunks) if compress else chunks
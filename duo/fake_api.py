@@ -0,0 +1,338 @@
+import collections
+import json
+import random
+import string
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Named synthetic tenant sizes, as number of users
+TENANT_SIZES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+}
+
+# Largest page size accepted per endpoint, as the real Admin API does
+PAGE_LIMITS = {
+    'users': 300,
+    'groups': 100,
+    'phones': 500,
+    'tokens': 500,
+}
+
+# Weighted fan-out per user, as (count, weight) tuples
+GROUPS_PER_USER = ((0, 20), (1, 40), (2, 25), (3, 10), (5, 5))
+PHONES_PER_USER = ((0, 10), (1, 75), (2, 13), (3, 2))
+TOKENS_PER_USER = ((0, 92), (1, 8))
+
+# Fraction of phones shared with another user, e.g. desk phones
+SHARED_PHONE_FRACTION = 0.01
+
+STATUSES = (('active', 90), ('disabled', 5), ('bypass', 3),
+            ('locked out', 2))
+PLATFORMS = (('Apple iOS', 50), ('Google Android', 40),
+             ('Generic Smartphone', 5), ('Unknown', 5))
+
+AUTHLOGS_PATH = '/admin/v2/logs/authentication'
+
+# Scripted fault closing the connection without a response
+DROP = 'drop'
+AUTHLOGS_PAGE_LIMIT = 1000
+
+# Authentication factors and results, cycled through by the log events
+FACTORS = ('duo_push', 'duo_push', 'duo_push', 'phone_call', 'passcode',
+           'sms_passcode')
+RESULTS = ('success',) * 9 + ('denied',)
+APPLICATIONS = ('VPN', 'Web SSO', 'Workstation Logon')
+
+
+def _pick(rng, weighted):
+    values, weights = zip(*weighted)
+    return rng.choices(values, weights)[0]
+
+
+def _duo_id(rng, prefix):
+    chars = string.ascii_uppercase + string.digits
+    return prefix + ''.join(rng.choice(chars) for _ in range(18))
+
+
+def generate_tenant(users, seed=0):
+    """Generate a synthetic Duo tenant.
+
+    :param users: number of users in the tenant
+    :param seed: random seed, the same seed always gives the same tenant
+    :return: dictionary of endpoint name -> list of API objects
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+
+    groups = []
+    for i in range(max(10, users // 100)):
+        groups.append({
+            'group_id': _duo_id(rng, 'DG'),
+            'name': 'Group %s' % i,
+            'desc': 'Synthetic group %s' % i,
+            'status': 'Active',
+            'mobile_otp_enabled': False,
+            'push_enabled': rng.random() < 0.5,
+            'sms_enabled': rng.random() < 0.5,
+            'voice_enabled': False,
+        })
+
+    tenant = {'users': [], 'groups': groups, 'phones': [], 'tokens': []}
+    owners = {}
+
+    for i in range(users):
+        user = {
+            'user_id': _duo_id(rng, 'DU'),
+            'username': 'user%06d' % i,
+            'email': 'user%06d@example.edu' % i,
+            'status': _pick(rng, STATUSES),
+            'realname': 'Synthetic User %s' % i,
+            'notes': '',
+            'created': now - rng.randint(0, 5 * 365 * 86400),
+            'is_enrolled': True,
+            'last_login': (
+                None if rng.random() < 0.1
+                else now - rng.randint(0, 365 * 86400)
+            ),
+            'groups': rng.sample(groups, _pick(rng, GROUPS_PER_USER)),
+            'phones': [],
+            'tokens': [],
+        }
+
+        for _ in range(_pick(rng, PHONES_PER_USER)):
+            if tenant['phones'] and rng.random() < SHARED_PHONE_FRACTION:
+                phone = rng.choice(tenant['phones'])
+            else:
+                platform = _pick(rng, PLATFORMS)
+                phone = {
+                    'phone_id': _duo_id(rng, 'DP'),
+                    'name': '',
+                    'number': '+1%010d' % rng.randint(2000000000, 9999999999),
+                    'extension': '',
+                    'type': 'Landline' if platform == 'Unknown' else 'Mobile',
+                    'platform': platform,
+                    'postdelay': None,
+                    'predelay': None,
+                    'sms_passcodes_sent': rng.random() < 0.3,
+                    'activated': rng.random() < 0.9,
+                    'capabilities': ['auto', 'push', 'sms', 'phone'],
+                }
+                tenant['phones'].append(phone)
+            user['phones'].append(phone)
+            owners.setdefault(phone['phone_id'], []).append(user)
+
+        for _ in range(_pick(rng, TOKENS_PER_USER)):
+            token = {
+                'serial': '%012d' % len(tenant['tokens']),
+                'token_id': _duo_id(rng, 'DH'),
+                'type': 'h6',
+                'totp_step': None,
+            }
+            tenant['tokens'].append(token)
+            user['tokens'].append(token)
+            owners[token['serial']] = [user]
+
+        tenant['users'].append(user)
+
+    # The phones and tokens endpoints list their users in brief
+    def brief(key):
+        def device_with_users(device):
+            return dict(device, users=[
+                {'user_id': user['user_id'], 'username': user['username']}
+                for user in owners[device[key]]
+            ])
+        return device_with_users
+
+    tenant['phones'] = list(map(brief('phone_id'), tenant['phones']))
+    tenant['tokens'] = list(map(brief('serial'), tenant['tokens']))
+
+    return tenant
+
+
+def authlog_event(tenant, index, interval):
+    """Build the index-th event of a synthetic authentication log.
+
+    Event i happens at i * interval ms after the epoch, so any time
+    range of the log can be served without storing it.
+
+    :param tenant: dictionary returned by generate_tenant
+    :param index: event number
+    :param interval: ms between two events
+    :return: v2 authentication log event
+    """
+    user = tenant['users'][(index * 7919) % len(tenant['users'])]
+    return {
+        'txid': 'TX%016d' % index,
+        'timestamp': index * interval // 1000,
+        'event_type': 'authentication',
+        'factor': FACTORS[index % len(FACTORS)],
+        'result': RESULTS[index % len(RESULTS)],
+        'reason': 'user_approved',
+        'user': {'key': user['user_id'], 'name': user['username']},
+        'application': {
+            'key': 'DI%018d' % (index % len(APPLICATIONS)),
+            'name': APPLICATIONS[index % len(APPLICATIONS)],
+        },
+        'access_device': {
+            'ip': '10.%s.%s.%s' % (index >> 16 & 255, index >> 8 & 255,
+                                   index & 255),
+            'location': {'city': 'Los Angeles', 'state': 'California',
+                         'country': 'United States'},
+        },
+        'auth_device': {
+            'name': user['phones'][0]['number'] if user['phones'] else None,
+        },
+    }
+
+
+class FakeAdminAPIHandler(BaseHTTPRequestHandler):
+    """Serve the paged Admin API list endpoints and the authentication
+    log from a synthetic tenant.
+
+    Requests are not signature checked.  Connections are kept alive
+    between requests, as with the real API.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        name = url.path.rsplit('/', 1)[-1]
+
+        with server.lock:
+            server.requests += 1
+            fault = server.faults.popleft() if server.faults else None
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if fault == DROP:
+            self.close_connection = True
+            return
+        if fault:
+            return self.reply(fault, {
+                'stat': 'FAIL', 'code': fault * 100 + 1,
+                'message': self.responses[fault][0]
+            })
+
+        if url.path == AUTHLOGS_PATH:
+            return self.authlogs(parse_qs(url.query))
+
+        if not url.path.startswith('/admin/v1/') or name not in PAGE_LIMITS:
+            return self.reply(404, {
+                'stat': 'FAIL', 'code': 40401, 'message': 'Resource not found'
+            })
+
+        if server.rate_limit and server.random.random() < server.rate_limit:
+            with server.lock:
+                server.throttled += 1
+            return self.reply(429, {
+                'stat': 'FAIL', 'code': 42901, 'message': 'Too Many Requests'
+            })
+
+        params = parse_qs(url.query)
+        limit = min(
+            int(params.get('limit', ['100'])[0]), PAGE_LIMITS[name]
+        )
+        offset = int(params.get('offset', ['0'])[0])
+        objects = server.tenant[name]
+
+        if (name, offset) in server.fail_pages:
+            return self.reply(503, {
+                'stat': 'FAIL', 'code': 50301,
+                'message': 'Service Unavailable'
+            })
+
+        metadata = {'total_objects': len(objects)}
+        if offset + limit < len(objects):
+            metadata['next_offset'] = offset + limit
+        if offset:
+            metadata['prev_offset'] = max(0, offset - limit)
+
+        self.reply(200, {
+            'stat': 'OK',
+            'response': objects[offset:offset + limit],
+            'metadata': metadata,
+        })
+
+    def authlogs(self, params):
+        server = self.server
+        interval = server.authlog_interval
+        limit = min(
+            int(params.get('limit', ['100'])[0]), AUTHLOGS_PAGE_LIMIT
+        )
+        mintime = int(params['mintime'][0])
+        maxtime = int(params['maxtime'][0])
+
+        # Events with index in [first, last] fall into the time range
+        first = -(-mintime // interval)
+        last = maxtime // interval
+        if 'next_offset' in params:
+            timestamp, txid = params['next_offset'][0].split(',')
+            first = int(txid[2:]) + 1
+
+        events = [
+            authlog_event(server.tenant, index, interval)
+            for index in range(first, min(last + 1, first + limit))
+        ]
+
+        metadata = {'total_objects': max(0, last - first + 1)}
+        if first + limit <= last:
+            metadata['next_offset'] = [
+                str(events[-1]['timestamp'] * 1000), events[-1]['txid']
+            ]
+
+        self.reply(200, {
+            'stat': 'OK',
+            'response': {'authlogs': events, 'metadata': metadata},
+        })
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(tenant, host='127.0.0.1', port=0, latency=0, rate_limit=0,
+                seed=0, authlog_rate=1.0, fail_pages=(), faults=()):
+    """Create a fake Admin API server for a synthetic tenant.
+
+    :param tenant: dictionary returned by generate_tenant
+    :param host: interface to listen on
+    :param port: port to listen on, 0 picks a free port
+    :param latency: seconds added to every request
+    :param rate_limit: fraction of requests answered with a 429
+    :param seed: random seed for the injected 429 responses
+    :param authlog_rate: authentication log events per second
+    :param fail_pages: (endpoint name, offset) pages always answered
+                       with a 503
+    :param faults: faults for the next requests in order, an HTTP error
+                   status to answer with, DROP to close the connection
+                   or None to answer normally
+    :return: ThreadingHTTPServer, call serve_forever() to start it
+    """
+    server = ThreadingHTTPServer((host, port), FakeAdminAPIHandler)
+    server.daemon_threads = True
+    server.tenant = tenant
+    server.latency = latency
+    server.rate_limit = rate_limit
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.throttled = 0
+    server.fail_pages = set(fail_pages)
+    server.faults = collections.deque(faults)
+    server.authlog_interval = max(1, int(1000 / authlog_rate))
+    return server
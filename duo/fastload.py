@@ -0,0 +1,281 @@
+import sqlite3
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+
+from duo.models import User
+from duo.sync import (
+    Loader, Upserted, StaleThresholdExceeded, RELATIONS, BATCH_SIZE,
+    MAX_STALE_FRACTION, fingerprint
+)
+
+
+# INSERT ... ON CONFLICT DO UPDATE needs SQLite 3.24
+MIN_SQLITE_VERSION = (3, 24, 0)
+
+# Page cache used during a bulk load, in KiB
+BULK_CACHE_SIZE = 64 * 1024
+
+# TEMP tables holding the Users and association pairs of a merge
+STAGE_USERS = 'duo_stage_users'
+STAGE_LINKS = 'duo_stage_links'
+
+
+def fast_load_supported():
+    """Return whether the database supports the SQLite merge loader."""
+    return (connection.vendor == 'sqlite' and
+            sqlite3.sqlite_version_info >= MIN_SQLITE_VERSION)
+
+
+@contextmanager
+def bulk_write_pragmas():
+    """Tune the SQLite connection for a bulk write, then restore it.
+
+    Switches to WAL with synchronous=NORMAL, so commits don't wait for
+    an fsync, and enlarges the page cache.  Must be used outside of a
+    transaction, since the journal mode can't change inside one.
+    """
+    pragmas = ('journal_mode', 'synchronous', 'cache_size')
+
+    with connection.cursor() as cursor:
+        saved = {}
+        for pragma in pragmas:
+            cursor.execute('PRAGMA %s' % pragma)
+            saved[pragma] = cursor.fetchone()[0]
+
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute('PRAGMA cache_size = -%d' % BULK_CACHE_SIZE)
+
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            for pragma in pragmas:
+                cursor.execute('PRAGMA %s = %s' % (pragma, saved[pragma]))
+
+
+def stage(cursor, table, columns, rows):
+    """Fill a TEMP staging table, creating it on first use.
+
+    :param cursor: database cursor
+    :param table: name of the staging table
+    :param columns: column and constraint definitions, e.g. ['id INTEGER']
+    :param rows: list of value tuples, one value per column
+    """
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS %s (%s)' % (
+        table, ', '.join(columns)
+    ))
+    cursor.execute('DELETE FROM %s' % table)
+    if rows:
+        cursor.executemany('INSERT INTO %s VALUES (%s)' % (
+            table, ', '.join(['%s'] * len(rows[0]))
+        ), rows)
+
+
+def merge_upsert(model, key_field, records, batch_size=BATCH_SIZE):
+    """Insert or update model rows with a set based SQLite merge.
+
+    Same contract as duo.sync.bulk_upsert.  The records are streamed
+    into a TEMP table with executemany and merged with a single
+    INSERT ... ON CONFLICT DO UPDATE, which skips rows whose stored
+    fingerprint matches.
+
+    :param model: Django model class
+    :param key_field: name of the unique natural key field
+    :param records: list of field dictionaries, each including key_field
+    :param batch_size: unused, the merge is a single statement
+    :return: Upserted tuple
+    """
+    records = {record[key_field]: record for record in records}
+    if not records:
+        return Upserted({}, set(), set(), 0)
+
+    for record in records.values():
+        if 'fingerprint' not in record:
+            record['fingerprint'] = fingerprint(record)
+
+    table = model._meta.db_table
+    fields = [model._meta.get_field(name)
+              for name in next(iter(records.values()))]
+    columns = [field.column for field in fields]
+    key = model._meta.get_field(key_field).column
+    stage_table = 'duo_stage_%s' % table
+
+    rows = [
+        tuple(field.get_db_prep_save(record[field.name], connection)
+              for field in fields)
+        for record in records.values()
+    ]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        stage(cursor, stage_table, columns, rows)
+
+        # Classify the staged rows before they are merged
+        cursor.execute(
+            'SELECT s.%(key)s, t.id, t.fingerprint IS NOT s.fingerprint '
+            'FROM %(stage)s s LEFT JOIN %(table)s t '
+            'ON t.%(key)s = s.%(key)s' % {
+                'key': key, 'stage': stage_table, 'table': table
+            }
+        )
+        pks = {}
+        created = set()
+        updated = set()
+        for natural_key, pk, changed in cursor.fetchall():
+            if pk is None:
+                created.add(natural_key)
+            else:
+                pks[natural_key] = pk
+                if changed:
+                    updated.add(natural_key)
+
+        # WHERE true keeps SQLite from parsing ON CONFLICT as a join
+        cursor.execute(
+            'INSERT INTO %(table)s (%(columns)s) '
+            'SELECT %(columns)s FROM %(stage)s WHERE true '
+            'ON CONFLICT (%(key)s) DO UPDATE SET %(updates)s '
+            'WHERE %(table)s.fingerprint IS NOT excluded.fingerprint' % {
+                'table': table,
+                'stage': stage_table,
+                'key': key,
+                'columns': ', '.join(columns),
+                'updates': ', '.join(
+                    '%s = excluded.%s' % (column, column)
+                    for column in columns if column != key
+                ),
+            }
+        )
+
+        if created:
+            cursor.execute(
+                'SELECT t.%(key)s, t.id FROM %(table)s t '
+                'JOIN %(stage)s s ON s.%(key)s = t.%(key)s' % {
+                    'key': key, 'stage': stage_table, 'table': table
+                }
+            )
+            pks.update(cursor.fetchall())
+
+        cursor.execute('DELETE FROM %s' % stage_table)
+
+    unchanged = len(records) - len(created) - len(updated)
+    return Upserted(pks, created, updated, unchanged)
+
+
+def merge_links(relation, desired, users, batch_size=BATCH_SIZE):
+    """Make a many to many through table match the desired pairs.
+
+    Same contract as duo.sync.reconcile_links, done with set based
+    INSERT ... ON CONFLICT DO NOTHING and DELETE ... WHERE NOT EXISTS
+    statements against TEMP tables of the desired pairs and Users.
+
+    :param relation: ManyToManyField descriptor, e.g. Group.users
+    :param desired: set of (model pk, User pk) tuples
+    :param users: set of User pks the desired pairs are complete for
+    :param batch_size: unused, every statement is set based
+    :return: tuple of (added, removed) sets of (model pk, User pk)
+    """
+    params = {
+        'through': relation.through._meta.db_table,
+        'source': relation.field.m2m_column_name(),
+        'target': relation.field.m2m_reverse_name(),
+        'links': STAGE_LINKS,
+        'users': STAGE_USERS,
+    }
+    # Through rows of the synced Users that are no longer desired
+    stale = (
+        'FROM %(through)s t '
+        'WHERE t.%(target)s IN (SELECT id FROM %(users)s) '
+        'AND NOT EXISTS (SELECT 1 FROM %(links)s l '
+        'WHERE l.source = t.%(source)s AND l.target = t.%(target)s)'
+    ) % params
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        stage(cursor, STAGE_LINKS, [
+            'source INTEGER', 'target INTEGER',
+            'PRIMARY KEY (source, target)'
+        ], list(desired))
+        stage(cursor, STAGE_USERS, ['id INTEGER PRIMARY KEY'],
+              [(pk,) for pk in users])
+
+        cursor.execute(
+            'SELECT l.source, l.target FROM %(links)s l WHERE NOT EXISTS '
+            '(SELECT 1 FROM %(through)s t WHERE t.%(source)s = l.source '
+            'AND t.%(target)s = l.target)' % params
+        )
+        added = set(cursor.fetchall())
+
+        cursor.execute(
+            'SELECT t.%(source)s, t.%(target)s ' % params + stale
+        )
+        removed = set(cursor.fetchall())
+
+        cursor.execute(
+            'INSERT INTO %(through)s (%(source)s, %(target)s) '
+            'SELECT source, target FROM %(links)s WHERE true '
+            'ON CONFLICT DO NOTHING' % params
+        )
+        cursor.execute(
+            'DELETE FROM %(through)s WHERE id IN (SELECT t.id ' % params +
+            stale + ')'
+        )
+
+        cursor.execute('DELETE FROM %s' % STAGE_LINKS)
+
+    return added, removed
+
+
+def merge_remove_stale(seen, max_fraction=MAX_STALE_FRACTION,
+                       batch_size=BATCH_SIZE):
+    """Remove local Users that were not returned by the API.
+
+    Same contract as duo.sync.remove_stale_users, with the Users and
+    their associations removed by DELETE ... WHERE NOT EXISTS.
+
+    :param seen: set of local User pks returned by the API this run
+    :param max_fraction: abort if more than this fraction would be removed
+    :param batch_size: unused, every statement is set based
+    :return: number of removed Users
+    :raises StaleThresholdExceeded: if too many Users look stale
+    """
+    table = User._meta.db_table
+    not_seen = (
+        'NOT EXISTS (SELECT 1 FROM %s s WHERE s.id = %%s)' % STAGE_USERS
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        stage(cursor, STAGE_USERS, ['id INTEGER PRIMARY KEY'],
+              [(pk,) for pk in seen])
+
+        cursor.execute('SELECT COUNT(*) FROM %s' % table)
+        local = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM %s u WHERE %s' % (
+            table, not_seen % 'u.id'
+        ))
+        stale = cursor.fetchone()[0]
+
+        if local and stale > local * max_fraction:
+            raise StaleThresholdExceeded(
+                '%s of %s local Users look stale, refusing to remove them' % (
+                    stale, local
+                )
+            )
+
+        for name, relation in RELATIONS:
+            through = relation.through._meta.db_table
+            target = relation.field.m2m_reverse_name()
+            cursor.execute('DELETE FROM %s WHERE %s' % (
+                through, not_seen % '%s.%s' % (through, target)
+            ))
+
+        cursor.execute('DELETE FROM %s WHERE %s' % (
+            table, not_seen % '%s.id' % table
+        ))
+
+    return stale
+
+
+# Loader merging through TEMP tables, see fast_load_supported
+SQLITE_LOADER = Loader(
+    merge_upsert, merge_links, merge_remove_stale, bulk_write_pragmas
+)
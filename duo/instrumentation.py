@@ -0,0 +1,235 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+# Upper bounds, in seconds, of the API latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class QueryCounter(object):
+    """Database execute wrapper counting queries and their time."""
+
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.time += time.time() - start
+
+
+class SyncMetrics(object):
+    """Timings and counters collected during a single sync run.
+
+    API requests may be observed from several fetch threads at once,
+    everything else is only touched by the thread writing to the DB.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.phases = OrderedDict()
+        self.api = {}
+        self.connections = {}
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the wall time and DB queries of a sync phase.
+
+        :param name: phase name
+        :return: dictionary the caller may add a 'rows' count to
+        """
+        counter = QueryCounter()
+        metrics = {'rows': 0}
+        start = time.time()
+
+        try:
+            with connection.execute_wrapper(counter):
+                yield metrics
+        finally:
+            metrics.update({
+                'wall_time': time.time() - start,
+                'queries': counter.queries,
+                'query_time': counter.time,
+            })
+            self.phases[name] = metrics
+
+    def endpoint(self, path):
+        """Return the API counters for an endpoint, creating them.
+
+        Must be called with the lock held.
+        """
+        if path not in self.api:
+            self.api[path] = {
+                'requests': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttled': 0,
+                'latency_sum': 0.0,
+                'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        return self.api[path]
+
+    def observe_request(self, path, seconds, status=None):
+        """Record a single API request.
+
+        :param path: endpoint path, without the query string
+        :param seconds: request latency
+        :param status: HTTP status, None if the request raised
+        """
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            api = self.endpoint(path)
+            api['requests'] += 1
+            api['latency_sum'] += seconds
+            api['buckets'][bucket] += 1
+            if status != 200:
+                api['errors'] += 1
+
+    def observe_retry(self, path, throttled=False):
+        """Record a retried API request.
+
+        :param path: endpoint path, without the query string
+        :param throttled: whether the retry follows a rate limit response
+        """
+        with self._lock:
+            api = self.endpoint(path)
+            api['retries'] += 1
+            if throttled:
+                api['throttled'] += 1
+
+    def as_dict(self):
+        """Return the metrics as JSON serializable data."""
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'wall_time': (self.finished or time.time()) - self.started,
+            'phases': self.phases,
+            'api': dict(
+                (path, dict(api, buckets=dict(zip(
+                    [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                    api['buckets']
+                ))))
+                for path, api in self.api.items()
+            ),
+            'connections': self.connections,
+            'rows': self.rows,
+        }
+
+    def prometheus(self, success):
+        """Render the metrics in the Prometheus text exposition format.
+
+        :param success: whether the run completed successfully
+        :return: string suitable for a node_exporter textfile
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP duo_sync_%s %s' % (name, help))
+            lines.append('# TYPE duo_sync_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label = ','.join(
+                    '%s="%s"' % (key, val) for key, val in labels
+                )
+                lines.append('duo_sync_%s%s%s %s' % (
+                    name, suffix, '{%s}' % label if label else '', value
+                ))
+
+        data = self.as_dict()
+        metric('last_run_timestamp_seconds', 'gauge',
+               'Time the last sync run finished.',
+               [('', (), data['finished'] or time.time())])
+        metric('last_run_success', 'gauge',
+               'Whether the last sync run completed.',
+               [('', (), int(bool(success)))])
+        metric('last_run_seconds', 'gauge',
+               'Wall time of the last sync run.',
+               [('', (), data['wall_time'])])
+
+        for key, name, help in (
+                ('wall_time', 'phase_seconds', 'Wall time of each phase.'),
+                ('queries', 'phase_queries', 'DB queries run by each phase.'),
+                ('query_time', 'phase_query_seconds',
+                 'DB time spent by each phase.'),
+                ('rows', 'phase_rows', 'Rows processed by each phase.')):
+            metric(name, 'gauge', help, [
+                ('', (('phase', phase),), values[key])
+                for phase, values in self.phases.items()
+            ])
+
+        metric('rows', 'gauge', 'Rows stored per endpoint and result.', [
+            ('', (('endpoint', name), ('result', result)), count)
+            for name, results in sorted(self.rows.items())
+            for result, count in sorted(results.items())
+        ])
+
+        for key, help in (('requests', 'Admin API requests.'),
+                          ('errors', 'Admin API requests that failed.'),
+                          ('retries', 'Admin API requests retried.'),
+                          ('throttled', 'Admin API rate limit responses.')):
+            metric('api_%s_total' % key, 'counter', help, [
+                ('', (('endpoint', path),), api[key])
+                for path, api in sorted(self.api.items())
+            ])
+
+        metric('api_connections', 'gauge',
+               'Admin API connections opened, reused and discarded.', [
+                   ('', (('state', state),), count)
+                   for state, count in sorted(self.connections.items())
+               ])
+
+        samples = []
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        for path, api in sorted(self.api.items()):
+            total = 0
+            for bound, count in zip(bounds, api['buckets']):
+                total += count
+                samples.append(
+                    ('_bucket', (('endpoint', path), ('le', bound)), total)
+                )
+            samples.append(('_sum', (('endpoint', path),), api['latency_sum']))
+            samples.append(('_count', (('endpoint', path),), api['requests']))
+        metric('api_request_seconds', 'histogram',
+               'Admin API request latency.', samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, success):
+        """Atomically write the metrics to a file.
+
+        Files ending in .prom get the Prometheus text format, anything
+        else is written as JSON.
+
+        :param path: destination file
+        :param success: whether the run completed successfully
+        """
+        if path.endswith('.prom'):
+            content = self.prometheus(success)
+        else:
+            content = json.dumps(
+                dict(self.as_dict(), success=success), indent=2
+            )
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
@@ -0,0 +1,71 @@
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+
+# Seconds between attempts to take a held lock
+LOCK_POLL_INTERVAL = 0.5
+
+
+class SyncLockHeld(Exception):
+    """Raised when another process holds the sync lock."""
+
+
+@contextmanager
+def sync_lock(path=None, timeout=0):
+    """Hold the advisory lock that lets a single sync write at a time.
+
+    The lock is an flock on a lock file, so it is released by the
+    kernel when the holding process dies, and the file carries the pid
+    of the holder for troubleshooting.
+
+    :param path: lock file, DUO_SYNC_LOCK_FILE by default
+    :param timeout: seconds to wait for a held lock, 0 to fail at once
+    :raises SyncLockHeld: if the lock is still held after timeout
+    """
+    path = path or settings.DUO_SYNC_LOCK_FILE
+    deadline = time.time() + timeout
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise SyncLockHeld(
+                        'Another Duo sync holds the lock on %s' % path
+                    )
+                time.sleep(LOCK_POLL_INTERVAL)
+
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode('ascii'))
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def locked(handle):
+    """Decorate a command's handle() to run under the sync lock.
+
+    A held lock fails the command at once, so a run started from cron
+    while the previous one is still writing is skipped.
+    """
+    @wraps(handle)
+    def wrapper(*args, **kwargs):
+        try:
+            with sync_lock():
+                return handle(*args, **kwargs)
+        except SyncLockHeld as e:
+            raise CommandError(e)
+
+    return wrapper
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from duo.api import FETCH_WORKERS, USERS_PAGE_SIZE
+from duo.fastload import fast_load_supported, SQLITE_LOADER
+from duo.sync import ORM_LOADER, MAX_STALE_FRACTION
+
+
+class DuoSyncCommand(BaseCommand):
+    """Base of the commands running a DuoSync.
+
+    Adds the --fast and --metrics-file options, and with fetches_users
+    set the --page-size, --workers and --max-stale-fraction options of
+    the user phases.  Subclasses adding options of their own call
+    add_arguments of this class first.
+    """
+
+    # Whether the command runs the user phases
+    fetches_users = True
+
+    def add_arguments(self, parser):
+        if self.fetches_users:
+            parser.add_argument(
+                '--page-size', type=int, default=USERS_PAGE_SIZE,
+                help='Number of users requested per API page'
+            )
+            parser.add_argument(
+                '--workers', type=int, default=FETCH_WORKERS,
+                help='Number of concurrent API requests'
+            )
+            parser.add_argument(
+                '--max-stale-fraction', type=float,
+                default=MAX_STALE_FRACTION,
+                help='Fail the run instead of removing stale accounts if a '
+                     'larger fraction of the local users would be removed'
+            )
+        parser.add_argument(
+            '--fast', action='store_true',
+            help='Merge the data through SQLite staging tables instead of '
+                 'the Django ORM (SQLite 3.24+ only)'
+        )
+        parser.add_argument(
+            '--metrics-file', default=settings.DUO_SYNC_METRICS_FILE,
+            help='Write the metrics of every run to this file, in the '
+                 'Prometheus text format if it ends in .prom and as JSON '
+                 'otherwise'
+        )
+
+    def sync_options(self, options):
+        """Build the DuoSync keyword arguments from the command options.
+
+        :param options: command options
+        :return: dictionary of DuoSync keyword arguments
+        :raises CommandError: if --fast is not supported by the database
+        """
+        if options['fast'] and not fast_load_supported():
+            raise CommandError('--fast needs an SQLite 3.24+ database')
+
+        sync_options = {
+            'loader': SQLITE_LOADER if options['fast'] else ORM_LOADER,
+        }
+        if self.fetches_users:
+            sync_options.update({
+                'workers': options['workers'],
+                'page_size': options['page_size'],
+                'max_stale_fraction': options['max_stale_fraction'],
+            })
+        return sync_options
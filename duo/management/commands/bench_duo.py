@@ -0,0 +1,237 @@
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import traceback
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings
+
+from duo.fake_api import generate_tenant, make_server, TENANT_SIZES
+from duo.instrumentation import QueryCounter
+
+
+# Commands that can be benchmarked, with the endpoints each one stores
+COMMANDS = {
+    'fetch_duo_groups': ('groups',),
+    'fetch_duo_users': ('users', 'phones', 'tokens'),
+    'sync_duo': ('groups', 'users', 'phones', 'tokens'),
+}
+
+
+def serve_tenant(conn, size, seed, latency, rate_limit):
+    """Serve a synthetic tenant, run in a child process.
+
+    The tenant lives in its own process so it does not count towards
+    the memory measured for the sync.
+    """
+    tenant = generate_tenant(TENANT_SIZES[size], seed=seed)
+    server = make_server(
+        tenant, latency=latency, rate_limit=rate_limit, seed=seed
+    )
+    conn.send((
+        server.server_port,
+        dict((name, len(objects)) for name, objects in tenant.items())
+    ))
+    server.serve_forever()
+
+
+def run_case(conn, port, commands, runs, options):
+    """Run the sync commands against a fresh database, in a child process.
+
+    The first run loads an empty database, later runs re-sync the
+    unchanged tenant.  Any failure is sent back as a traceback string.
+    """
+    try:
+        conn.send(measure(port, commands, runs, options))
+    except BaseException:
+        conn.send(traceback.format_exc())
+
+
+def run_command(conn, name, kwargs):
+    """Run and measure a single command, in a child process.
+
+    Each command runs in a fresh process, since ru_maxrss is the peak
+    over the whole life of a process: measured in one process, every
+    resync would report the peak of the initial load again.  The peak
+    still includes the memory inherited from the forking process.
+    """
+    try:
+        counter = QueryCounter()
+        start = time.time()
+        with connection.execute_wrapper(counter):
+            call_command(name, stdout=io.StringIO(), **kwargs)
+        elapsed = time.time() - start
+
+        conn.send({
+            'wall_time': round(elapsed, 3),
+            'queries': counter.queries,
+            'query_time': round(counter.time, 3),
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF
+            ).ru_maxrss,
+        })
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        connection.close()
+
+
+def measure(port, commands, runs, options):
+    fd, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+
+    connection.close()
+    connection.settings_dict['TEST']['NAME'] = path
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    results = []
+    try:
+        with override_settings(DUO_IKEY='bench', DUO_SKEY='bench',
+                               DUO_HOST='127.0.0.1:%s' % port,
+                               DUO_CA_CERTS='HTTP'):
+            for run in range(runs):
+                for name in commands:
+                    kwargs = {}
+                    if name != 'fetch_duo_groups':
+                        kwargs['workers'] = options['workers']
+
+                    # The child must open its own connection to the file
+                    connection.close()
+                    parent_conn, child_conn = multiprocessing.Pipe()
+                    child = multiprocessing.Process(
+                        target=run_command, args=(child_conn, name, kwargs)
+                    )
+                    child.start()
+                    result = parent_conn.recv()
+                    child.join()
+
+                    if isinstance(result, str):
+                        raise RuntimeError(
+                            '%s failed:\n%s' % (name, result)
+                        )
+
+                    results.append(dict({
+                        'command': name,
+                        'run': 'initial' if run == 0 else 'resync',
+                    }, **result))
+    finally:
+        connection.creation.destroy_test_db(path, verbosity=0)
+
+    return results
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark the sync commands against a local fake Admin API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', choices=sorted(TENANT_SIZES),
+            default=['1k', '10k'], metavar='SIZE',
+            help='Synthetic tenant sizes (%s)' % ', '.join(
+                sorted(TENANT_SIZES, key=TENANT_SIZES.get)
+            )
+        )
+        parser.add_argument(
+            '--commands', nargs='+', choices=sorted(COMMANDS),
+            default=['fetch_duo_groups', 'fetch_duo_users'],
+            metavar='COMMAND', help='Commands to run, in order'
+        )
+        parser.add_argument(
+            '--runs', type=int, default=2,
+            help='Number of runs per size, the first loads an empty database'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of concurrent API requests'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Seconds the fake API adds to every request'
+        )
+        parser.add_argument(
+            '--rate-limit', type=float, default=0,
+            help='Fraction of requests the fake API answers with a 429'
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--output', default='bench_duo.json',
+            help='JSON file the results are written to'
+        )
+
+    def handle(self, *args, **options):
+
+        # Child processes must not share the parent's connections
+        connections.close_all()
+
+        cases = []
+        for size in sorted(options['sizes'], key=TENANT_SIZES.get):
+
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Benchmarking the %s synthetic tenant...' % size
+            )
+
+            server_conn, child_conn = multiprocessing.Pipe()
+            server = multiprocessing.Process(
+                target=serve_tenant, daemon=True,
+                args=(child_conn, size, options['seed'],
+                      options['latency'], options['rate_limit'])
+            )
+            server.start()
+            port, counts = server_conn.recv()
+
+            try:
+                case_conn, child_conn = multiprocessing.Pipe()
+                case = multiprocessing.Process(
+                    target=run_case,
+                    args=(child_conn, port, options['commands'],
+                          options['runs'], options)
+                )
+                case.start()
+                results = case_conn.recv()
+                case.join()
+            finally:
+                server.terminate()
+
+            if isinstance(results, str):
+                raise CommandError(
+                    'Benchmark of the %s tenant failed:\n%s' % (size, results)
+                )
+
+            for result in results:
+                rows = sum(counts[name] for name in COMMANDS[result['command']])
+                result.update({
+                    'size': size,
+                    'rows': rows,
+                    'rows_per_second': round(rows / result['wall_time'], 1),
+                })
+                cases.append(result)
+
+                self.stdout.write(
+                    self.style.WARNING('[-]') +
+                    ' %(size)s %(command)s (%(run)s): %(wall_time)ss, '
+                    '%(queries)s queries, %(peak_rss_kb)s KB peak RSS, '
+                    '%(rows_per_second)s rows/s' % result
+                )
+
+        with open(options['output'], 'w') as f:
+            json.dump({
+                'created': datetime.datetime.utcnow().isoformat() + 'Z',
+                'latency': options['latency'],
+                'rate_limit': options['rate_limit'],
+                'workers': options['workers'],
+                'cases': cases,
+            }, f, indent=2)
+
+        self.stdout.write(
+            self.style.SUCCESS('[√]') +
+            ' Results written to %s' % options['output']
+        )
@@ -0,0 +1,93 @@
+import signal
+
+from django.core.management.base import CommandError
+
+from duo.api import get_admin_api
+from duo.daemon import (
+    SyncDaemon, default_jobs, start_health_server, GROUPS_INTERVAL,
+    USERS_INTERVAL, DEVICES_INTERVAL, JITTER
+)
+from duo.management.base import DuoSyncCommand
+
+
+class Command(DuoSyncCommand):
+
+    help = 'Keep syncing Duo Groups, Users and devices on a schedule'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--groups-interval', type=float, default=GROUPS_INTERVAL,
+            help='Seconds between group syncs, 0 to disable them'
+        )
+        parser.add_argument(
+            '--users-interval', type=float, default=USERS_INTERVAL,
+            help='Seconds between user syncs, 0 to disable them'
+        )
+        parser.add_argument(
+            '--devices-interval', type=float, default=DEVICES_INTERVAL,
+            help='Seconds between phone and token syncs, 0 to disable them'
+        )
+        parser.add_argument(
+            '--jitter', type=float, default=JITTER,
+            help='Fraction of the interval each run is moved by at random'
+        )
+        parser.add_argument(
+            '--health-host', default='127.0.0.1',
+            help='Interface the health endpoint listens on'
+        )
+        parser.add_argument(
+            '--health-port', type=int, default=8082,
+            help='Port of the health endpoint, 0 to disable it'
+        )
+
+    def handle(self, *args, **options):
+
+        sync_options = self.sync_options(options)
+
+        jobs = default_jobs(
+            groups=options['groups_interval'],
+            users=options['users_interval'],
+            devices=options['devices_interval'],
+            jitter=options['jitter']
+        )
+        if not jobs:
+            raise CommandError('Every job is disabled')
+
+        # One API client, and its connection pool, serves every run
+        daemon = SyncDaemon(
+            get_admin_api(), self, jobs,
+            sync_options=sync_options, metrics_file=options['metrics_file']
+        )
+
+        # Finish the running job before exiting
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: daemon.stop())
+
+        server = None
+        if options['health_port']:
+            server = start_health_server(
+                daemon, options['health_host'], options['health_port']
+            )
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Serving the health endpoint on http://%s:%s/health' % (
+                    options['health_host'], server.server_port
+                )
+            )
+
+        self.stdout.write(
+            self.style.WARNING('[-]') + ' Scheduling %s' % ', '.join(
+                '%s every %ss' % (job.name, job.interval) for job in jobs
+            )
+        )
+
+        try:
+            daemon.run_forever()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            daemon.admin_api.pool.close()
+
+        self.stdout.write(self.style.SUCCESS('[√]') + ' Stopped')
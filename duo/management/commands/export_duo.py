@@ -0,0 +1,51 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from duo.export import export_users, EXPORT_CHUNK_SIZE, FORMATS
+
+
+class Command(BaseCommand):
+
+    help = 'Export all Duo Users with their groups, phones and tokens'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=FORMATS, default='csv',
+            help='Output format'
+        )
+        parser.add_argument(
+            '--output', '-o',
+            help='Write to this file instead of stdout, gzip compressed '
+                 'if it ends in .gz'
+        )
+        parser.add_argument(
+            '--gzip', action='store_true',
+            help='Compress the output with gzip'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+            help='Number of users read per query'
+        )
+
+    def handle(self, *args, **options):
+
+        output = options['output']
+        compress = options['gzip'] or bool(output and output.endswith('.gz'))
+
+        chunks = export_users(
+            options['format'], compress, options['chunk_size']
+        )
+
+        if output:
+            # Text chunks are encoded here, gzip chunks are already bytes
+            with open(output, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk if compress else chunk.encode('utf-8'))
+        elif compress:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+
+from duo.fake_api import generate_tenant, make_server, TENANT_SIZES
+
+
+class Command(BaseCommand):
+
+    help = 'Serve a synthetic Duo tenant from a local fake Admin API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', choices=sorted(TENANT_SIZES), default='1k',
+            help='Synthetic tenant size'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed for the synthetic tenant'
+        )
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='Seconds added to every request'
+        )
+        parser.add_argument(
+            '--rate-limit', type=float, default=0,
+            help='Fraction of requests answered with a 429'
+        )
+        parser.add_argument(
+            '--authlog-rate', type=float, default=1.0,
+            help='Authentication log events per second'
+        )
+
+    def handle(self, *args, **options):
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Generating the %s synthetic tenant...' % options['size']
+        )
+
+        tenant = generate_tenant(
+            TENANT_SIZES[options['size']], seed=options['seed']
+        )
+        server = make_server(
+            tenant, options['host'], options['port'],
+            latency=options['latency'], rate_limit=options['rate_limit'],
+            seed=options['seed'], authlog_rate=options['authlog_rate']
+        )
+
+        self.stdout.write(
+            self.style.SUCCESS('[√]') +
+            ' Serving %s users, %s groups, %s phones and %s tokens on '
+            'http://%s:%s (set DUO_HOST=%s:%s DUO_CA_CERTS=HTTP)' % (
+                len(tenant['users']), len(tenant['groups']),
+                len(tenant['phones']), len(tenant['tokens']),
+                options['host'], server.server_port,
+                options['host'], server.server_port,
+            )
+        )
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,60 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from duo.api import get_admin_api, AUTHLOGS_PAGE_SIZE
+from duo.authlogs import fetch_authlogs, prune_authlogs, INITIAL_DAYS
+from duo.sync import SYNC_ERRORS
+
+
+class Command(BaseCommand):
+
+    help = 'Fetch new Duo authentication log events via Admin API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--initial-days', type=int, default=INITIAL_DAYS,
+            help='Days of history fetched when no events were fetched yet'
+        )
+        parser.add_argument(
+            '--page-size', type=int, default=AUTHLOGS_PAGE_SIZE,
+            help='Number of events requested per API page'
+        )
+        parser.add_argument(
+            '--retention-days', type=int,
+            default=settings.DUO_AUTHLOG_RETENTION_DAYS,
+            help='Remove events older than this many days'
+        )
+
+    def handle(self, *args, **options):
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Creating Duo Admin Client and querying the API...'
+        )
+
+        started = time.time()
+        try:
+            fetched, inserted = fetch_authlogs(
+                get_admin_api(),
+                initial_days=options['initial_days'],
+                limit=options['page_size']
+            )
+        except SYNC_ERRORS as e:
+            raise CommandError('%s (%s)' % (e, type(e).__name__))
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Duo Authentication Log: %s fetched, %s inserted in %.2fs' % (
+                fetched, inserted, time.time() - started
+            )
+        )
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Removed expired authentication log events (%s)' %
+            prune_authlogs(options['retention_days'])
+        )
+
+        self.stdout.write(self.style.SUCCESS('[√]') + ' Finished!')
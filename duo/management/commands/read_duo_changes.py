@@ -0,0 +1,37 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.management.base import BaseCommand
+
+from duo.changes import changes_since, serialize_event
+
+
+class Command(BaseCommand):
+
+    help = 'Print the Duo change events after a generation as JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=int, default=0,
+            help='Last sync generation already read, 0 for every event'
+        )
+        parser.add_argument(
+            '--after', type=int, default=0,
+            help='Id of the last event already read'
+        )
+        parser.add_argument(
+            '--kind', help='Only print events of this kind'
+        )
+
+    def handle(self, *args, **options):
+
+        queryset = changes_since(options['since']).filter(
+            pk__gt=options['after']
+        )
+        if options['kind']:
+            queryset = queryset.filter(kind=options['kind'])
+
+        for event in queryset.iterator():
+            self.stdout.write(
+                json.dumps(serialize_event(event), cls=DjangoJSONEncoder)
+            )
@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from duo.cache import set_last_sync
+from duo.locking import locked
+from duo.models import SyncRun
+from duo.snapshot import SnapshotError, PREV_SUFFIX, live_database, swap_in
+
+
+class Command(BaseCommand):
+
+    help = 'Restore the Duo data from before the last snapshot sync'
+
+    @locked
+    def handle(self, *args, **options):
+
+        try:
+            previous = live_database() + PREV_SUFFIX
+        except SnapshotError as e:
+            raise CommandError(e)
+
+        if not os.path.exists(previous):
+            raise CommandError('No previous snapshot at %s' % previous)
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Restoring the Duo data from %s' % previous
+        )
+
+        tables = swap_in(previous)
+
+        # The history is kept, the rollback is recorded as a run of its
+        # own and starts a new cache generation
+        set_last_sync(SyncRun.objects.create(
+            command='rollback_duo', finished=timezone.now(), success=True
+        ))
+
+        self.stdout.write(
+            self.style.SUCCESS('[√]') + ' Restored %s tables' % tables
+        )
@@ -0,0 +1,101 @@
+import os
+
+from django.core.management.base import CommandError
+
+from duo.api import get_admin_api
+from duo.cache import set_last_sync
+from duo.changes import prune_changes
+from duo.locking import locked
+from duo.management.base import DuoSyncCommand
+from duo.snapshot import (
+    SnapshotError, NEXT_SUFFIX, live_database, record_runs, shadow_database,
+    swap_in
+)
+from duo.sync import DuoSync
+
+
+class Command(DuoSyncCommand):
+
+    help = 'Sync Duo Groups, Users, devices and memberships via Admin API'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--only', nargs='+', choices=DuoSync.PHASES, metavar='PHASE',
+            help='Run only these phases (%s)' % ', '.join(DuoSync.PHASES)
+        )
+        parser.add_argument(
+            '--skip', nargs='+', choices=DuoSync.PHASES, metavar='PHASE',
+            default=[], help='Skip these phases'
+        )
+        parser.add_argument(
+            '--snapshot', action='store_true',
+            help='Sync into a shadow copy of the database and swap it in '
+                 'once complete, keeping the previous data for rollback_duo '
+                 '(SQLite only)'
+        )
+
+    @locked
+    def handle(self, *args, **options):
+
+        sync_options = self.sync_options(options)
+
+        phases = [
+            phase for phase in options['only'] or DuoSync.PHASES
+            if phase not in options['skip']
+        ]
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Creating Duo Admin Client and running phases: %s' % (
+                ', '.join(phase for phase in DuoSync.PHASES
+                          if phase in phases)
+            )
+        )
+
+        if not options['snapshot']:
+            sync = self.sync(phases, sync_options, options['metrics_file'])
+        else:
+            try:
+                live_database()
+            except SnapshotError as e:
+                raise CommandError(e)
+
+            # Readers keep the previous data until the swap commits, and
+            # the cache generation only moves on once they see the new one
+            shadow = live_database() + NEXT_SUFFIX
+            try:
+                with shadow_database():
+                    sync = self.sync(phases, sync_options,
+                                     options['metrics_file'], publish=False)
+            except BaseException:
+                if os.path.exists(shadow):
+                    record_runs(shadow)
+                raise
+            tables = swap_in(shadow)
+            set_last_sync(sync.sync_run)
+            prune_changes()
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Swapped in the new snapshot (%s tables)' % tables
+            )
+
+        sync.report()
+
+        self.stdout.write(self.style.SUCCESS('[√]') + ' Finished!')
+
+    def sync(self, phases, sync_options, metrics_file, publish=True):
+        """Run the phases and record the outcome of the run.
+
+        :param phases: names of the phases to run
+        :param sync_options: DuoSync keyword arguments, see sync_options
+        :param metrics_file: see DuoSync.finish
+        :param publish: see DuoSync.finish
+        :return: finished DuoSync
+        """
+        # One API client is shared by every phase of the run
+        sync = DuoSync(get_admin_api(), self, **sync_options)
+
+        with sync.finishing(metrics_file, publish=publish):
+            sync.run(phases)
+        return sync
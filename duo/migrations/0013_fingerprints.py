@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0012_auto_20180329_1519'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='phone',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+    ]
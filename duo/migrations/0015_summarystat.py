@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0014_syncrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SummaryStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=200)),
+                ('key', models.CharField(max_length=200)),
+                ('value', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('metric', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, OperationalError
+
+
+def create_search_index(apps, schema_editor):
+    from duo.search import create_index
+
+    # Other backends, or SQLite built without FTS5, use the LIKE fallback
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            create_index(cursor)
+        except OperationalError:
+            # no such module: fts5
+            pass
+
+
+def drop_search_index(apps, schema_editor):
+    from duo.search import SEARCH_TABLE
+
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS %s' % SEARCH_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0015_summarystat'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:09
+
+from django.db import migrations, models
+
+
+# Covering indexes for the user -> groups/phones/tokens lookups.  The
+# auto-created through tables only index user_id on its own, so each
+# match still had to read the table row for the other id.
+THROUGH_INDEXES = (
+    ('duo_group_users', 'group_id'),
+    ('duo_phone_users', 'phone_id'),
+    ('duo_token_users', 'token_id'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0016_user_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='group',
+            index=models.Index(fields=['name'], name='duo_group_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phone',
+            index=models.Index(fields=['number'], name='duo_phone_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phone',
+            index=models.Index(fields=['platform', 'type'], name='duo_phone_platform_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phone',
+            index=models.Index(fields=['type'], name='duo_phone_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(fields=['type'], name='duo_token_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['username'], name='duo_user_username_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email'], name='duo_user_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['status', 'last_login'], name='duo_user_status_login_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['last_login'], name='duo_user_login_idx'),
+        ),
+    ] + [
+        migrations.RunSQL(
+            'CREATE INDEX %s_user_cover_idx ON %s (user_id, %s)' % (
+                table, table, column
+            ),
+            'DROP INDEX %s_user_cover_idx' % table,
+        )
+        for table, column in THROUGH_INDEXES
+    ]
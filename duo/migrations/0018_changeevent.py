@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0017_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('kind', models.CharField(choices=[('user_added', 'User added'), ('user_removed', 'User removed'), ('status_changed', 'Status changed'), ('phone_added', 'Phone added'), ('phone_removed', 'Phone removed'), ('token_added', 'Token added'), ('token_removed', 'Token removed'), ('group_joined', 'Group joined'), ('group_left', 'Group left')], max_length=20)),
+                ('user_id', models.CharField(max_length=200)),
+                ('username', models.CharField(max_length=200)),
+                ('object_id', models.CharField(max_length=200, null=True)),
+                ('old_value', models.CharField(max_length=200, null=True)),
+                ('new_value', models.CharField(max_length=200, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='changeevent',
+            index=models.Index(fields=['generation'], name='duo_change_generation_idx'),
+        ),
+    ]
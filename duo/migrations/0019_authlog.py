@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0018_changeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('txid', models.CharField(max_length=200, unique=True)),
+                ('timestamp', models.DateTimeField()),
+                ('user_id', models.CharField(max_length=200, null=True)),
+                ('username', models.CharField(max_length=200, null=True)),
+                ('event_type', models.CharField(max_length=200, null=True)),
+                ('factor', models.CharField(max_length=200, null=True)),
+                ('result', models.CharField(max_length=200, null=True)),
+                ('reason', models.CharField(max_length=200, null=True)),
+                ('application', models.CharField(max_length=200, null=True)),
+                ('ip', models.CharField(max_length=200, null=True)),
+                ('city', models.CharField(max_length=200, null=True)),
+                ('state', models.CharField(max_length=200, null=True)),
+                ('country', models.CharField(max_length=200, null=True)),
+                ('device', models.CharField(max_length=200, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+                ('mintime', models.BigIntegerField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='authlog',
+            index=models.Index(fields=['timestamp'], name='duo_authlog_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='authlog',
+            index=models.Index(fields=['username', 'timestamp'], name='duo_authlog_user_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+def fill_numbers(apps, schema_editor):
+    from duo.phones import normalize_number, number_suffix
+
+    # Later syncs keep the columns up to date
+    Phone = apps.get_model('duo', 'Phone')
+    phones = list(Phone.objects.only('pk', 'number'))
+    for phone in phones:
+        phone.e164 = normalize_number(phone.number)
+        phone.number_suffix = number_suffix(phone.e164 or phone.number)
+    Phone.objects.bulk_update(phones, ['e164', 'number_suffix'],
+                              batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0019_authlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phone',
+            name='e164',
+            field=models.CharField(editable=False, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='phone',
+            name='number_suffix',
+            field=models.CharField(editable=False, max_length=10, null=True),
+        ),
+        migrations.RunPython(fill_numbers, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='phone',
+            index=models.Index(fields=['e164'], name='duo_phone_e164_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phone',
+            index=models.Index(fields=['number_suffix'], name='duo_phone_suffix_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('duo', '0020_phone_e164'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='changeevent',
+            index=models.Index(fields=['kind'], name='duo_change_kind_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='group',
+            index=models.Index(fields=['status'], name='duo_group_status_idx'),
+        ),
+    ]
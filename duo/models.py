@@ -10,6 +10,16 @@ class User(models.Model):
     realname = models.CharField(max_length=200, null=True)
     notes = models.CharField(max_length=200)
     last_login = models.DateTimeField('last login', null=True)
+    fingerprint = models.CharField(max_length=40, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['username'], name='duo_user_username_idx'),
+            models.Index(fields=['email'], name='duo_user_email_idx'),
+            models.Index(fields=['status', 'last_login'],
+                         name='duo_user_status_login_idx'),
+            models.Index(fields=['last_login'], name='duo_user_login_idx'),
+        ]
 
 
 # Duo Group model
@@ -22,8 +32,15 @@ class Group(models.Model):
     push_enabled = models.BooleanField(default=False)
     sms_enabled = models.BooleanField(default=False)
     voice_enabled = models.BooleanField(default=False)
+    fingerprint = models.CharField(max_length=40, null=True, editable=False)
     users = models.ManyToManyField(User)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['name'], name='duo_group_name_idx'),
+            models.Index(fields=['status'], name='duo_group_status_idx'),
+        ]
+
 
 # Duo Token model
 class Token(models.Model):
@@ -31,8 +48,14 @@ class Token(models.Model):
     token_id = models.CharField(max_length=200)
     type = models.CharField(max_length=200)
     totp_step = models.CharField(max_length=200, null=True)
+    fingerprint = models.CharField(max_length=40, null=True, editable=False)
     users = models.ManyToManyField(User)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['type'], name='duo_token_type_idx'),
+        ]
+
 
 # Duo Phone model
 class Phone(models.Model):
@@ -46,5 +69,115 @@ class Phone(models.Model):
     predelay = models.CharField(max_length=200, null=True)
     sms_passcodes_sent = models.CharField(max_length=200, null=True)
     activated = models.CharField(max_length=200, null=True)
+    # Normalized number and its last digits reversed, see duo.phones
+    e164 = models.CharField(max_length=16, null=True, editable=False)
+    number_suffix = models.CharField(max_length=10, null=True,
+                                     editable=False)
+    fingerprint = models.CharField(max_length=40, null=True, editable=False)
     users = models.ManyToManyField(User)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['number'], name='duo_phone_number_idx'),
+            models.Index(fields=['e164'], name='duo_phone_e164_idx'),
+            models.Index(fields=['number_suffix'],
+                         name='duo_phone_suffix_idx'),
+            models.Index(fields=['platform', 'type'],
+                         name='duo_phone_platform_type_idx'),
+            models.Index(fields=['type'], name='duo_phone_type_idx'),
+        ]
+
+
+# Record of a single sync run and the metrics collected during it
+class SyncRun(models.Model):
+    command = models.CharField(max_length=200)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+    success = models.NullBooleanField()
+    metrics = models.TextField(default='{}')
+
+
+# Dashboard aggregate, recomputed at the end of every sync
+class SummaryStat(models.Model):
+    metric = models.CharField(max_length=200)
+    key = models.CharField(max_length=200)
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('metric', 'key')
+
+
+# Append only record of a change made by a sync, see duo.changes
+class ChangeEvent(models.Model):
+    USER_ADDED = 'user_added'
+    USER_REMOVED = 'user_removed'
+    STATUS_CHANGED = 'status_changed'
+    PHONE_ADDED = 'phone_added'
+    PHONE_REMOVED = 'phone_removed'
+    TOKEN_ADDED = 'token_added'
+    TOKEN_REMOVED = 'token_removed'
+    GROUP_JOINED = 'group_joined'
+    GROUP_LEFT = 'group_left'
+    KINDS = (
+        (USER_ADDED, 'User added'),
+        (USER_REMOVED, 'User removed'),
+        (STATUS_CHANGED, 'Status changed'),
+        (PHONE_ADDED, 'Phone added'),
+        (PHONE_REMOVED, 'Phone removed'),
+        (TOKEN_ADDED, 'Token added'),
+        (TOKEN_REMOVED, 'Token removed'),
+        (GROUP_JOINED, 'Group joined'),
+        (GROUP_LEFT, 'Group left'),
+    )
+
+    # Sync generation, the pk of the SyncRun that made the change
+    generation = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    user_id = models.CharField(max_length=200)
+    username = models.CharField(max_length=200)
+    # group_id, phone_id or serial of the joined or added object
+    object_id = models.CharField(max_length=200, null=True)
+    old_value = models.CharField(max_length=200, null=True)
+    new_value = models.CharField(max_length=200, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['generation'],
+                         name='duo_change_generation_idx'),
+            models.Index(fields=['kind'], name='duo_change_kind_idx'),
+        ]
+
+
+# Duo authentication log event, see duo.authlogs
+class AuthLog(models.Model):
+    txid = models.CharField(max_length=200, unique=True)
+    timestamp = models.DateTimeField()
+    user_id = models.CharField(max_length=200, null=True)
+    username = models.CharField(max_length=200, null=True)
+    event_type = models.CharField(max_length=200, null=True)
+    factor = models.CharField(max_length=200, null=True)
+    result = models.CharField(max_length=200, null=True)
+    reason = models.CharField(max_length=200, null=True)
+    application = models.CharField(max_length=200, null=True)
+    ip = models.CharField(max_length=200, null=True)
+    city = models.CharField(max_length=200, null=True)
+    state = models.CharField(max_length=200, null=True)
+    country = models.CharField(max_length=200, null=True)
+    device = models.CharField(max_length=200, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['timestamp'],
+                         name='duo_authlog_timestamp_idx'),
+            models.Index(fields=['username', 'timestamp'],
+                         name='duo_authlog_user_idx'),
+        ]
+
+
+# Resume point of an incremental fetch, e.g. the authentication log
+class Checkpoint(models.Model):
+    name = models.CharField(max_length=200, unique=True)
+    # Unix timestamp in ms the next fetch starts from
+    mintime = models.BigIntegerField()
+    updated = models.DateTimeField(auto_now=True)
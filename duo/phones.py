@@ -0,0 +1,83 @@
+import re
+
+from django.conf import settings
+
+
+# Digits kept, reversed, in Phone.number_suffix, enough for a full
+# national number so callers dialing without a country code still match
+SUFFIX_DIGITS = 10
+
+# Fewest digits a lookup may match on, shorter suffixes match too much
+MIN_LOOKUP_DIGITS = 4
+
+# E.164 numbers have at most 15 digits
+MAX_E164_DIGITS = 15
+
+
+def digits(number):
+    return re.sub(r'\D', '', number or '')
+
+
+def normalize_number(number, country_code=None):
+    """Normalize a free form phone number to E.164.
+
+    Numbers with a leading + or 00 already carry their country code.
+    National numbers get DUO_PHONE_COUNTRY_CODE, after dropping a
+    leading trunk 0.  With country code 1 they must be NANP numbers of
+    10 digits, optionally after a leading 1.
+
+    :param number: phone number as entered, e.g. '(213) 555-0100'
+    :param country_code: country code of national numbers, by default
+                         DUO_PHONE_COUNTRY_CODE
+    :return: E.164 number, e.g. '+12135550100', None if the number
+             can't be normalized
+    """
+    if country_code is None:
+        country_code = settings.DUO_PHONE_COUNTRY_CODE
+
+    number = (number or '').strip()
+    national = digits(number)
+    if not national:
+        return None
+
+    if number.startswith('+'):
+        e164 = national
+    elif national.startswith('00'):
+        e164 = national[2:]
+    elif country_code == '1':
+        # NANP national numbers are 10 digits, optionally after a 1
+        if len(national) == 11 and national[0] == '1':
+            e164 = national
+        elif len(national) == 10:
+            e164 = country_code + national
+        else:
+            return None
+    else:
+        e164 = country_code + national.lstrip('0')
+
+    if not e164 or len(e164) > MAX_E164_DIGITS:
+        return None
+    return '+' + e164
+
+
+def number_suffix(number):
+    """Build the reversed last digits key of a phone number.
+
+    Reversing turns a match on the last digits into a match on the
+    key's first digits, which an index range scan answers.
+
+    :param number: phone number, normalized or not
+    :return: last SUFFIX_DIGITS digits reversed, None without digits
+    """
+    return digits(number)[-SUFFIX_DIGITS:][::-1] or None
+
+
+def suffix_range(number):
+    """Return the number_suffix range matching the last digits typed.
+
+    :param number: last digits of a phone number, e.g. '555-0100'
+    :return: tuple of (lowest key, key just above the range)
+    """
+    key = digits(number)[-SUFFIX_DIGITS:][::-1]
+    # ':' sorts right after '9', so every key starting with key is lower
+    return key, key + ':'
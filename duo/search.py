@@ -0,0 +1,155 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from duo.models import User
+
+
+# FTS5 table indexing each User by pk, created by migration 0016
+SEARCH_TABLE = 'duo_user_search'
+
+# Number of Users re-indexed per statement
+INDEX_BATCH_SIZE = 500
+
+# Default and largest number of search results
+SEARCH_LIMIT = 25
+MAX_SEARCH_LIMIT = 200
+
+# Rows indexed for a User: the searchable fields and its group names
+INDEX_SELECT = '''
+    SELECT u.id, u.username, u.email, COALESCE(u.realname, ''),
+           COALESCE(GROUP_CONCAT(g.name, ' '), '')
+    FROM duo_user u
+    LEFT JOIN duo_group_users gu ON gu.user_id = u.id
+    LEFT JOIN duo_group g ON g.id = gu.group_id
+'''
+
+
+def fts_enabled():
+    """Return whether the FTS5 search table exists.
+
+    It is only created on SQLite builds with FTS5, other backends use
+    the LIKE based fallback.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    return SEARCH_TABLE in connection.introspection.table_names()
+
+
+def create_index(cursor):
+    """Create and fill the FTS5 search table.
+
+    Prefix indexes on 2 and 3 characters make short prefix queries,
+    the usual partial username or name, as fast as full terms.
+
+    :param cursor: database cursor
+    """
+    cursor.execute(
+        "CREATE VIRTUAL TABLE %s USING fts5("
+        "username, email, realname, groups, "
+        "prefix='2 3', tokenize='unicode61')" % SEARCH_TABLE
+    )
+    cursor.execute(
+        'INSERT INTO %s (rowid, username, email, realname, groups) '
+        '%s GROUP BY u.id' % (SEARCH_TABLE, INDEX_SELECT)
+    )
+
+
+def index_users(pks, batch_size=INDEX_BATCH_SIZE):
+    """Re-index the given Users, dropping those that no longer exist.
+
+    :param pks: User pks whose fields or group memberships changed
+    :param batch_size: number of Users per statement
+    :return: number of re-indexed User pks
+    """
+    if not fts_enabled():
+        return 0
+
+    pks = sorted(pks)
+    with connection.cursor() as cursor:
+        for i in range(0, len(pks), batch_size):
+            chunk = pks[i:i + batch_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(
+                'DELETE FROM %s WHERE rowid IN (%s)' % (
+                    SEARCH_TABLE, placeholders
+                ), chunk
+            )
+            cursor.execute(
+                'INSERT INTO %s (rowid, username, email, realname, groups) '
+                '%s WHERE u.id IN (%s) GROUP BY u.id' % (
+                    SEARCH_TABLE, INDEX_SELECT, placeholders
+                ), chunk
+            )
+
+    return len(pks)
+
+
+def prune_index():
+    """Drop the index rows of Users that have been deleted.
+
+    :return: number of dropped rows
+    """
+    if not fts_enabled():
+        return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM %s WHERE rowid NOT IN (SELECT id FROM duo_user)'
+            % SEARCH_TABLE
+        )
+        return cursor.rowcount
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query matching every word as a prefix.
+
+    Words are quoted, so FTS5 operators typed by the user are searched
+    for literally.
+
+    :param query: search text, e.g. 'jsm usc.edu'
+    :return: FTS5 MATCH expression, None if there is nothing to search
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def search_users(query, limit=SEARCH_LIMIT):
+    """Search Users by partial username, email, real name or group name.
+
+    With FTS5 the matches are ranked by bm25, otherwise every word has
+    to be contained in one of the fields and matches are ordered by
+    username.
+
+    :param query: search text
+    :param limit: largest number of Users returned
+    :return: list of User instances
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+
+    if not fts_enabled():
+        queryset = User.objects.all()
+        for word in re.findall(r'\w+', query):
+            queryset = queryset.filter(
+                Q(username__icontains=word) |
+                Q(email__icontains=word) |
+                Q(realname__icontains=word) |
+                Q(group__name__icontains=word)
+            )
+        return list(queryset.distinct().order_by('username')[:limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY rank '
+            'LIMIT %%s' % (SEARCH_TABLE, SEARCH_TABLE),
+            [expression, limit]
+        )
+        pks = [row[0] for row in cursor.fetchall()]
+
+    users = User.objects.in_bulk(pks)
+    return [users[pk] for pk in pks if pk in users]
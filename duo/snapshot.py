@@ -0,0 +1,184 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from django.db import connection
+
+from duo.models import (
+    User, Group, Phone, Token, SummaryStat, SyncRun, ChangeEvent
+)
+from duo.search import SEARCH_TABLE
+
+
+# Suffixes of the snapshot files kept next to the live database
+NEXT_SUFFIX = '.next'
+PREV_SUFFIX = '.prev'
+
+
+class SnapshotError(Exception):
+    """Raised when the database can't be synced as a snapshot."""
+
+
+def snapshot_tables():
+    """Return the tables a snapshot replaces, those written by a sync.
+
+    Authentication, session and admin tables are never swapped, and the
+    append only history tables are appended to, see history_tables.
+    """
+    tables = [
+        model._meta.db_table
+        for model in (User, Group, Phone, Token, SummaryStat)
+    ]
+    tables += [
+        model.users.through._meta.db_table for model in (Group, Phone, Token)
+    ]
+    if SEARCH_TABLE in connection.introspection.table_names():
+        tables.append(SEARCH_TABLE)
+    return tables
+
+
+def history_tables():
+    """Return the append only tables a snapshot adds its new rows to."""
+    return [model._meta.db_table for model in (SyncRun, ChangeEvent)]
+
+
+def live_database():
+    """Return the path of the live SQLite database file.
+
+    :raises SnapshotError: for other backends and in-memory databases
+    """
+    name = connection.settings_dict['NAME']
+    if connection.vendor != 'sqlite' or not name or ':memory:' in str(name):
+        raise SnapshotError('Snapshots need a file based SQLite database')
+    return str(name)
+
+
+def copy_database(source, target):
+    """Copy an SQLite database with the online backup API.
+
+    The copy is consistent even while other connections write.
+
+    :param source: path of the database to copy
+    :param target: path of the copy, replaced if it exists
+    """
+    if os.path.exists(target):
+        os.remove(target)
+
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+@contextmanager
+def shadow_database():
+    """Point the default connection at a shadow copy of the database.
+
+    The live database is copied to <name>.prev, the snapshot readers
+    currently see, and to <name>.next, which is written by the sync
+    run inside the block.  Call swap_in(<name>.next) afterwards to make
+    the new snapshot live, or record_runs(<name>.next) to keep only the
+    record of a failed run.
+
+    :return: path of the shadow database
+    """
+    live = live_database()
+    shadow = live + NEXT_SUFFIX
+
+    connection.close()
+    copy_database(live, live + PREV_SUFFIX)
+    copy_database(live, shadow)
+
+    connection.settings_dict['NAME'] = shadow
+    try:
+        yield shadow
+    finally:
+        connection.close()
+        connection.settings_dict['NAME'] = live
+
+
+def swap_in(path):
+    """Replace the sync tables of the live database with a snapshot.
+
+    The sync tables are replaced, and the rows the snapshot added to
+    the history tables appended, in a single transaction, so readers
+    see either the previous or the new snapshot.  The write lock is
+    held for a copy of the sync tables only, never of the history.
+
+    :param path: snapshot database, e.g. <name>.next or <name>.prev
+    :return: number of swapped tables
+    """
+    tables = snapshot_tables()
+
+    with attached(path) as cursor:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for table in tables:
+                cursor.execute('DELETE FROM main.%s' % table)
+                copy_rows(cursor, table)
+            for table in history_tables():
+                append_rows(cursor, table)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    return len(tables)
+
+
+def record_runs(path):
+    """Append the SyncRuns a snapshot added, without any of its data.
+
+    Keeps the record of a failed snapshot run, whose data is dropped.
+
+    :param path: snapshot database, e.g. <name>.next
+    """
+    with attached(path) as cursor:
+        append_rows(cursor, SyncRun._meta.db_table)
+
+
+@contextmanager
+def attached(path):
+    """Attach a snapshot database to the live connection as snapshot.
+
+    :return: cursor of the live connection
+    """
+    live_database()
+    if not os.path.exists(path):
+        raise SnapshotError('No snapshot at %s' % path)
+
+    with connection.cursor() as cursor:
+        cursor.execute('ATTACH DATABASE %s AS snapshot', [path])
+        try:
+            yield cursor
+        finally:
+            cursor.execute('DETACH DATABASE snapshot')
+
+
+def copy_rows(cursor, table, where=''):
+    cursor.execute(
+        'INSERT INTO main.%(table)s (rowid, %(columns)s) '
+        'SELECT rowid, %(columns)s FROM snapshot.%(table)s %(where)s'
+        % {'table': table, 'columns': ', '.join(columns(cursor, table)),
+           'where': where}
+    )
+
+
+def append_rows(cursor, table):
+    # Rows above the live rowids were added by the snapshot run, the
+    # sync lock keeps anything else from appending in the meantime
+    copy_rows(cursor, table, 'WHERE rowid > (SELECT COALESCE(MAX(rowid), '
+                             '0) FROM main.%s)' % table)
+
+
+def columns(cursor, table):
+    """Return the column names of a table in the live database."""
+    return [
+        column.name
+        for column in connection.introspection.get_table_description(
+            cursor, table
+        )
+    ]
@@ -0,0 +1,149 @@
+import datetime
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from duo.cache import cached
+from duo.models import User, Group, Phone, Token, SummaryStat
+
+
+# last_login age buckets, as (key, upper bound in days)
+LAST_LOGIN_BUCKETS = (
+    ('1d', 1),
+    ('7d', 7),
+    ('30d', 30),
+    ('90d', 90),
+    ('365d', 365),
+)
+
+
+def count_by(queryset, field):
+    """Return (value, count) pairs of a field.
+
+    NULL and empty values are counted together as 'none', so each key
+    appears once.
+    """
+    counts = OrderedDict()
+    for row in queryset.values(field).annotate(
+            count=Count('pk')).order_by(field):
+        key = row[field] if row[field] not in (None, '') else 'none'
+        counts[key] = counts.get(key, 0) + row['count']
+    return list(counts.items())
+
+
+def compute_summary(now=None):
+    """Compute every dashboard aggregate.
+
+    Each metric is a single aggregate query over its table.
+
+    :param now: reference time for the last_login buckets
+    :return: list of (metric, key, value) tuples
+    """
+    now = now or timezone.now()
+    stats = []
+
+    stats += [
+        ('totals', 'users', User.objects.count()),
+        ('totals', 'groups', Group.objects.count()),
+        ('totals', 'phones', Phone.objects.count()),
+        ('totals', 'tokens', Token.objects.count()),
+    ]
+
+    stats += [
+        ('users_by_status', status, count)
+        for status, count in count_by(User.objects.all(), 'status')
+    ]
+
+    devices = User.objects.aggregate(
+        without_phones=Count('pk', filter=~Q(
+            pk__in=Phone.users.through.objects.values('user_id')
+        )),
+        without_tokens=Count('pk', filter=~Q(
+            pk__in=Token.users.through.objects.values('user_id')
+        )),
+        without_devices=Count('pk', filter=~Q(
+            pk__in=Phone.users.through.objects.values('user_id')
+        ) & ~Q(
+            pk__in=Token.users.through.objects.values('user_id')
+        )),
+    )
+    stats += [
+        ('users_devices', key, devices[key])
+        for key in ('without_phones', 'without_tokens', 'without_devices')
+    ]
+
+    # Buckets are exclusive, e.g. 7d counts logins between 1 and 7 days ago
+    buckets = {'never': Count('pk', filter=Q(last_login__isnull=True))}
+    lower = None
+    for key, days in LAST_LOGIN_BUCKETS:
+        since = now - datetime.timedelta(days=days)
+        buckets[key] = Count('pk', filter=Q(last_login__gte=since) & (
+            Q(last_login__lt=lower) if lower else Q()
+        ))
+        lower = since
+    buckets['older'] = Count('pk', filter=Q(last_login__lt=lower))
+
+    ages = User.objects.aggregate(**buckets)
+    stats += [
+        ('last_login_age', key, ages[key])
+        for key in [key for key, days in LAST_LOGIN_BUCKETS] +
+        ['older', 'never']
+    ]
+
+    stats += [
+        ('phones_by_platform', platform, count)
+        for platform, count in count_by(Phone.objects.all(), 'platform')
+    ]
+    stats += [
+        ('phones_by_type', type, count)
+        for type, count in count_by(Phone.objects.all(), 'type')
+    ]
+
+    # Keyed on group_id, since group names need not be unique
+    stats += [
+        ('group_sizes', group_id, count)
+        for group_id, count in Group.objects.annotate(
+            count=Count('users')
+        ).order_by('group_id').values_list('group_id', 'count')
+    ]
+
+    return stats
+
+
+def refresh_summary(now=None):
+    """Recompute the SummaryStat table in a single transaction.
+
+    :param now: reference time for the last_login buckets
+    :return: number of SummaryStat rows
+    """
+    stats = compute_summary(now)
+
+    with transaction.atomic():
+        SummaryStat.objects.all().delete()
+        SummaryStat.objects.bulk_create(
+            SummaryStat(metric=metric, key=key, value=value)
+            for metric, key, value in stats
+        )
+
+    return len(stats)
+
+
+def get_summary():
+    """Return the dashboard aggregates computed by the last sync.
+
+    Reads the precomputed SummaryStat rows, cached until the next sync,
+    so the cost does not depend on the number of Users.
+
+    :return: dictionary of metric -> ordered dictionary of key -> value
+    """
+    return cached('summary', load_summary)
+
+
+def load_summary():
+    summary = OrderedDict()
+    for metric, key, value in SummaryStat.objects.order_by('pk').values_list(
+            'metric', 'key', 'value'):
+        summary.setdefault(metric, OrderedDict())[key] = value
+    return summary
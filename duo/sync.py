@@ -0,0 +1,1037 @@
+import datetime
+import hashlib
+import http.client
+import json
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import contextmanager
+
+import pytz
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from duo.api import ConcurrentFetcher, iter_pages, ENDPOINTS, USERS_PAGE_SIZE
+from duo.cache import set_last_sync
+from duo.changes import emit, natural_keys, prune_changes, LINK_EVENTS
+from duo.instrumentation import SyncMetrics
+from duo.models import User, Group, Phone, Token, SyncRun, ChangeEvent
+from duo.phones import normalize_number, number_suffix
+from duo.search import index_users, prune_index
+from duo.summary import refresh_summary
+
+
+# Number of rows written per bulk_create/bulk_update statement
+BATCH_SIZE = 500
+
+# Largest fraction of local Users a sync may remove before it is treated
+# as an API glitch rather than a real offboarding
+MAX_STALE_FRACTION = 0.1
+
+# Result of bulk_upsert: natural key -> pk for every record, the sets of
+# created and updated natural keys and the number of unchanged rows
+Upserted = namedtuple('Upserted', 'pks created updated unchanged')
+
+# Functions writing the synced data: upsert as bulk_upsert, reconcile as
+# reconcile_links, remove_stale as remove_stale_users and tuning, a
+# context manager preparing the connection for the writes of a run
+Loader = namedtuple('Loader', 'upsert reconcile remove_stale tuning')
+
+
+class StaleThresholdExceeded(Exception):
+    """Raised when a sync would remove too many local Users."""
+
+
+# Errors failing a run that are not a bug: Duo API errors, the network
+# errors still left once a request runs out of retries and a refused
+# removal of stale Users
+SYNC_ERRORS = (RuntimeError, OSError, http.client.HTTPException,
+               StaleThresholdExceeded)
+
+
+def normalize_user(user):
+    """Build the local User field dictionary for a Duo API user.
+
+    :param user: user object returned by the Duo Admin API
+    :return: dictionary of User model fields
+    """
+    # Just picking a timezone since we have to....
+    timezone = pytz.timezone("America/New_York")
+
+    # Django model DateTimeField does not play nice
+    # with Unix Timestamps.  Check to see if it exists
+    # and convert it to a Datetime format with timezone
+    if user['last_login'] is not None:
+        last_login = datetime.datetime.fromtimestamp(
+            user['last_login'],
+            tz=timezone
+        )
+    else:
+        last_login = None
+
+    return {
+        'user_id': user['user_id'],
+        'username': user['username'],
+        'email': user['email'],
+        'status': user['status'],
+        'realname': user['realname'],
+        'notes': user['notes'],
+        'last_login': last_login
+    }
+
+
+def normalize_group(group):
+    """Build the local Group field dictionary for a Duo API group.
+
+    :param group: group object returned by the Duo Admin API
+    :return: dictionary of Group model fields
+    """
+    return {
+        'group_id': group['group_id'],
+        'name': group['name'],
+        'desc': group['desc'],
+        'status': group['status'],
+        'mobile_otp_enabled': group['mobile_otp_enabled'],
+        'push_enabled': group['push_enabled'],
+        'sms_enabled': group['sms_enabled'],
+        'voice_enabled': group['voice_enabled'],
+    }
+
+
+def normalize_phone(phone):
+    """Build the local Phone field dictionary for a Duo API phone.
+
+    :param phone: phone object returned by the Duo Admin API
+    :return: dictionary of Phone model fields
+    """
+    # Indexed for reverse lookups by number, see duo.phones
+    e164 = normalize_number(phone['number'])
+
+    return {
+        'phone_id': phone['phone_id'],
+        'name': phone['name'],
+        'number': phone['number'],
+        'extension': phone['extension'],
+        'type': phone['type'],
+        'platform': phone['platform'],
+        'postdelay': phone['postdelay'],
+        'predelay': phone['predelay'],
+        'sms_passcodes_sent': phone['sms_passcodes_sent'],
+        'activated': phone['activated'],
+        'e164': e164,
+        'number_suffix': number_suffix(e164 or phone['number']),
+    }
+
+
+def normalize_token(token):
+    """Build the local Token field dictionary for a Duo API token.
+
+    :param token: token object returned by the Duo Admin API
+    :return: dictionary of Token model fields
+    """
+    return {
+        'serial': token['serial'],
+        'token_id': token['token_id'],
+        'type': token['type'],
+        'totp_step': token['totp_step'],
+    }
+
+
+def fingerprint(record):
+    """Hash a normalized record so unchanged rows can be skipped.
+
+    :param record: dictionary of JSON serializable values
+    :return: hex digest of the record
+    """
+    payload = json.dumps(record, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def existing_rows(model, key_field, keys, batch_size=BATCH_SIZE):
+    """Map natural keys to (pk, fingerprint) for rows that already exist.
+
+    Small key sets are looked up with batched IN queries.  Anything
+    larger than a single batch is served by one scan of the table,
+    which keeps the query count constant for full syncs.
+
+    :param model: Django model class
+    :param key_field: name of the unique natural key field
+    :param keys: natural key values to look up
+    :param batch_size: maximum number of keys per IN query
+    :return: dictionary of natural key -> (primary key, fingerprint)
+    """
+    keys = set(keys)
+    queryset = model.objects.values_list(key_field, 'pk', 'fingerprint')
+
+    if len(keys) > batch_size:
+        return {
+            key: (pk, digest)
+            for key, pk, digest in queryset.iterator() if key in keys
+        }
+
+    return {
+        key: (pk, digest)
+        for key, pk, digest in queryset.filter(**{key_field + '__in': keys})
+    }
+
+
+def bulk_upsert(model, key_field, records, batch_size=BATCH_SIZE):
+    """Insert or update model rows from field dictionaries.
+
+    Existing rows are loaded keyed by key_field, new and changed rows
+    are worked out in memory and written with batched bulk_create and
+    bulk_update calls inside a single transaction.  Rows whose stored
+    fingerprint matches the record are not written at all.
+
+    :param model: Django model class
+    :param key_field: name of the unique natural key field
+    :param records: list of field dictionaries, each including key_field
+        and optionally a precomputed fingerprint
+    :param batch_size: number of rows per bulk statement
+    :return: Upserted tuple
+    """
+    # Later records win if the API returned the same key twice
+    records = {record[key_field]: record for record in records}
+    if not records:
+        return Upserted({}, set(), set(), 0)
+
+    for record in records.values():
+        if 'fingerprint' not in record:
+            record['fingerprint'] = fingerprint(record)
+
+    fields = [
+        field for field in next(iter(records.values()))
+        if field != key_field
+    ]
+
+    existing = existing_rows(model, key_field, records, batch_size)
+    pks = {key: pk for key, (pk, digest) in existing.items()}
+
+    inserts = []
+    updates = []
+    for key, record in records.items():
+        if key not in existing:
+            inserts.append(model(**record))
+        elif existing[key][1] != record['fingerprint']:
+            updates.append(model(pk=pks[key], **record))
+
+    with transaction.atomic():
+        model.objects.bulk_create(inserts, batch_size=batch_size)
+        model.objects.bulk_update(updates, fields, batch_size=batch_size)
+
+    # SQLite does not return primary keys from bulk_create
+    created = set(getattr(obj, key_field) for obj in inserts)
+    if created:
+        pks.update(
+            (key, pk) for key, (pk, digest)
+            in existing_rows(model, key_field, created, batch_size).items()
+        )
+
+    updated = set(getattr(obj, key_field) for obj in updates)
+    unchanged = len(records) - len(created) - len(updated)
+
+    return Upserted(pks, created, updated, unchanged)
+
+
+def upsert_users(users, batch_size=BATCH_SIZE, upsert=bulk_upsert):
+    """Bulk insert/update local Users from Duo API user objects.
+
+    :param users: list of user objects returned by the Duo Admin API
+    :param batch_size: number of rows per bulk statement
+    :param upsert: bulk upsert function, e.g. a Loader upsert
+    :return: Upserted tuple keyed by user_id
+    """
+    return upsert(
+        User, 'user_id', [normalize_user(user) for user in users], batch_size
+    )
+
+
+def upsert_groups(groups, batch_size=BATCH_SIZE, upsert=bulk_upsert):
+    """Bulk insert/update local Groups from Duo API group objects.
+
+    :param groups: list of group objects returned by the Duo Admin API
+    :param batch_size: number of rows per bulk statement
+    :param upsert: bulk upsert function, e.g. a Loader upsert
+    :return: Upserted tuple keyed by group_id
+    """
+    return upsert(
+        Group, 'group_id', [normalize_group(group) for group in groups],
+        batch_size
+    )
+
+
+def upsert_phones(phones, batch_size=BATCH_SIZE, upsert=bulk_upsert):
+    """Bulk insert/update local Phones from Duo API phone objects.
+
+    :param phones: list of phone objects returned by the Duo Admin API
+    :param batch_size: number of rows per bulk statement
+    :param upsert: bulk upsert function, e.g. a Loader upsert
+    :return: Upserted tuple keyed by phone_id
+    """
+    return upsert(
+        Phone, 'phone_id', [normalize_phone(phone) for phone in phones],
+        batch_size
+    )
+
+
+def upsert_tokens(tokens, batch_size=BATCH_SIZE, upsert=bulk_upsert):
+    """Bulk insert/update local Tokens from Duo API token objects.
+
+    :param tokens: list of token objects returned by the Duo Admin API
+    :param batch_size: number of rows per bulk statement
+    :param upsert: bulk upsert function, e.g. a Loader upsert
+    :return: Upserted tuple keyed by serial
+    """
+    return upsert(
+        Token, 'serial', [normalize_token(token) for token in tokens],
+        batch_size
+    )
+
+
+def add_links(relation, pairs, batch_size=BATCH_SIZE):
+    """Bulk insert many to many rows, ignoring pairs that already exist.
+
+    :param relation: ManyToManyField descriptor, e.g. Group.users
+    :param pairs: iterable of (model pk, User pk) tuples
+    :param batch_size: number of rows per bulk statement
+    """
+    through = relation.through
+    source = relation.field.m2m_field_name() + '_id'
+    target = relation.field.m2m_reverse_field_name() + '_id'
+
+    through.objects.bulk_create(
+        [through(**{source: pk, target: user_pk}) for pk, user_pk in pairs],
+        batch_size=batch_size,
+        ignore_conflicts=True
+    )
+
+
+def reconcile_links(relation, desired, users, batch_size=BATCH_SIZE):
+    """Make a many to many through table match the desired pairs.
+
+    The current pairs are read in one query and diffed against the
+    desired set in memory.  Missing pairs are bulk inserted and pairs
+    that should no longer exist are deleted in chunks.  Only pairs for
+    the given Users are removed, so Users that were not part of this
+    sync keep their associations.
+
+    :param relation: ManyToManyField descriptor, e.g. Group.users
+    :param desired: set of (model pk, User pk) tuples
+    :param users: set of User pks the desired pairs are complete for
+    :param batch_size: number of rows per bulk statement
+    :return: tuple of (added, removed) sets of (model pk, User pk)
+    """
+    through = relation.through
+    source = relation.field.m2m_field_name() + '_id'
+    target = relation.field.m2m_reverse_field_name() + '_id'
+
+    existing = {
+        (pk, user_pk): through_pk for through_pk, pk, user_pk
+        in through.objects.values_list('pk', source, target).iterator()
+    }
+
+    missing = desired.difference(existing)
+    extra = dict(
+        (pair, through_pk) for pair, through_pk in existing.items()
+        if pair[1] in users and pair not in desired
+    )
+    extra_pks = list(extra.values())
+
+    with transaction.atomic():
+        add_links(relation, missing, batch_size)
+        for i in range(0, len(extra_pks), batch_size):
+            through.objects.filter(
+                pk__in=extra_pks[i:i + batch_size]
+            ).delete()
+
+    return missing, set(extra)
+
+
+def delete_pks(model, pks, batch_size=BATCH_SIZE):
+    """Delete rows by primary key in chunks.
+
+    Each chunk is a single set based DELETE, with Django clearing the
+    many to many through rows for the whole chunk at once.
+
+    :param model: Django model class
+    :param pks: primary keys of the rows to delete
+    :param batch_size: number of rows per DELETE statement
+    :return: number of deleted rows
+    """
+    pks = sorted(pks)
+
+    with transaction.atomic():
+        for i in range(0, len(pks), batch_size):
+            model.objects.filter(pk__in=pks[i:i + batch_size]).delete()
+
+    return len(pks)
+
+
+def remove_stale_users(seen, max_fraction=MAX_STALE_FRACTION,
+                       batch_size=BATCH_SIZE):
+    """Remove local Users that were not returned by the API.
+
+    :param seen: set of local User pks returned by the API this run
+    :param max_fraction: abort if more than this fraction would be removed
+    :param batch_size: number of rows per DELETE statement
+    :return: number of removed Users
+    :raises StaleThresholdExceeded: if too many Users look stale
+    """
+    local = set(User.objects.values_list('pk', flat=True))
+    stale = local - seen
+
+    if local and len(stale) > len(local) * max_fraction:
+        raise StaleThresholdExceeded(
+            '%s of %s local Users look stale, refusing to remove them' % (
+                len(stale), len(local)
+            )
+        )
+
+    return delete_pks(User, stale, batch_size)
+
+
+def remove_orphans(model, seen=(), batch_size=BATCH_SIZE):
+    """Remove Phones or Tokens that no User references anymore.
+
+    Devices returned by the API this run are kept even when unassigned.
+
+    :param model: Phone or Token
+    :param seen: set of pks returned by the API this run
+    :param batch_size: number of rows per DELETE statement
+    :return: number of removed rows
+    """
+    orphans = set(
+        model.objects.filter(users__isnull=True).values_list('pk', flat=True)
+    )
+
+    return delete_pks(model, orphans - set(seen), batch_size)
+
+
+@contextmanager
+def default_tuning():
+    yield
+
+
+# Loader using the Django ORM, works on every database backend
+ORM_LOADER = Loader(
+    bulk_upsert, reconcile_links, remove_stale_users, default_tuning
+)
+
+# Natural key field and bulk upsert function per device endpoint
+DEVICES = {
+    'phones': ('phone_id', upsert_phones),
+    'tokens': ('serial', upsert_tokens),
+}
+
+# User associations reconciled at the end of the run
+RELATIONS = (
+    ('groups', Group.users),
+    ('phones', Phone.users),
+    ('tokens', Token.users),
+)
+
+
+class DuoSync(object):
+    """A single run of the Duo sync, split into ordered phases.
+
+    The run keeps the state shared between phases: the local pks seen
+    per endpoint, the group and device indexes and the desired User
+    associations.  Output is written through the calling command.
+
+    Every run is recorded as a SyncRun along with its metrics.
+    """
+
+    # Phases in the order they have to run
+    PHASES = ('groups', 'users', 'devices', 'memberships', 'stale', 'search')
+
+    # API endpoints fetched by each phase
+    PHASE_ENDPOINTS = {
+        'groups': ('groups',),
+        'users': ('users',),
+        'devices': ('phones', 'tokens'),
+    }
+
+    def __init__(self, admin_api, command, workers=1,
+                 page_size=USERS_PAGE_SIZE,
+                 max_stale_fraction=MAX_STALE_FRACTION,
+                 loader=ORM_LOADER):
+        """
+        :param admin_api: duo.api.Admin instance shared by all phases
+        :param command: management command used for output and recorded
+                        on the SyncRun
+        :param workers: number of concurrent API requests
+        :param page_size: number of users requested per API page
+        :param max_stale_fraction: see remove_stale_users
+        :param loader: Loader writing the data, e.g. the SQLite specific
+                       duo.fastload.SQLITE_LOADER
+        """
+        self.admin_api = admin_api
+        self.stdout = command.stdout
+        self.style = command.style
+        self.workers = workers
+        self.max_stale_fraction = max_stale_fraction
+        self.loader = loader
+
+        self.endpoints = dict(ENDPOINTS)
+        self.endpoints['users'] = ('/admin/v1/users', page_size)
+
+        # Primary keys of every local row returned by the API, per endpoint
+        self.seen = defaultdict(set)
+
+        # Inserted/updated/unchanged/deleted row counts per endpoint
+        self.stats = defaultdict(Counter)
+
+        # group_id -> local Group pk, loaded on the first user page
+        self.group_pks = None
+
+        # User pk -> (user_id, username, status) of every local User,
+        # loaded on the first user page to describe change events
+        self.user_index = None
+
+        # phone_id/serial -> local pk of every device stored this run
+        self.device_pks = {'phones': {}, 'tokens': {}}
+
+        # Desired (Group/Phone/Token pk, User pk) pairs for the whole run
+        self.links = defaultdict(set)
+
+        # Primary keys of the rows inserted or updated, per endpoint, and
+        # of the Users whose Group memberships changed
+        self.changed = defaultdict(set)
+
+        # Phase timings, query counts and API latencies of the run
+        self.metrics = SyncMetrics()
+        self.admin_api.metrics = self.metrics
+
+        # Connection counters before the run, the client may be reused
+        pool = getattr(self.admin_api, 'pool', None)
+        self.pool_baseline = pool.stats() if pool is not None else None
+
+        self.sync_run = SyncRun.objects.create(
+            command=command.__module__.rsplit('.', 1)[-1]
+        )
+
+    def run(self, phases=PHASES):
+        """Run the given phases in order, each in its own transaction.
+
+        :param phases: names of the phases to run
+        """
+        with self.loader.tuning():
+            for phase in self.PHASES:
+                if phase not in phases:
+                    continue
+
+                with self.metrics.phase(phase) as metrics:
+                    with transaction.atomic():
+                        metrics['rows'] = getattr(self, 'run_' + phase)()
+
+                self.report_phase(phase)
+
+    @contextmanager
+    def finishing(self, metrics_file=None, publish=True):
+        """Record the outcome of the phases run inside the block.
+
+        The run is finished even when the block fails, so its SyncRun,
+        metrics file and API connections are always closed out.
+        SYNC_ERRORS are then raised as a CommandError.
+
+        :param metrics_file: see finish
+        :param publish: see finish
+        """
+        try:
+            yield self
+        except SYNC_ERRORS as e:
+            self.finish(False, metrics_file)
+            raise CommandError('%s (%s)' % (e, type(e).__name__))
+        except BaseException:
+            self.finish(False, metrics_file)
+            raise
+        self.finish(True, metrics_file, publish=publish)
+
+    def report_phase(self, phase):
+        """Write the timings of a finished phase.
+
+        :param phase: name of the phase
+        """
+        metrics = self.metrics.phases[phase]
+        rows = metrics['rows']
+        elapsed = metrics['wall_time']
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Phase %s: %s rows in %.2fs (%.0f rows/s), '
+            '%s queries in %.2fs' % (
+                phase, rows, elapsed, rows / elapsed if elapsed else 0,
+                metrics['queries'], metrics['query_time']
+            )
+        )
+
+    def run_groups(self):
+        return self.fetch(self.PHASE_ENDPOINTS['groups'])
+
+    def run_users(self):
+        return self.fetch(self.PHASE_ENDPOINTS['users'])
+
+    def run_devices(self):
+        return self.fetch(self.PHASE_ENDPOINTS['devices'])
+
+    def run_memberships(self):
+        if 'users' not in self.seen:
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Skipping memberships, no users were fetched'
+            )
+            return 0
+
+        return self.store_links()
+
+    def run_stale(self):
+        if 'users' not in self.seen:
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Skipping stale cleanup, no users were fetched'
+            )
+            return 0
+
+        return self.remove_stale()
+
+    def run_search(self):
+        return self.update_search()
+
+    def pages(self, names):
+        """Fetch the given endpoints a page at a time.
+
+        With more than one worker the pages are fetched concurrently
+        and arrive interleaved.  A (name, None) tuple marks the end of
+        each endpoint.
+
+        :param names: endpoint names, see duo.api.ENDPOINTS
+        :return: generator of (name, list of API objects or None)
+        """
+        if self.workers > 1:
+            fetcher = ConcurrentFetcher(
+                dict((name, self.endpoints[name]) for name in names),
+                max_workers=self.workers,
+                client_factory=lambda: self.admin_api
+            )
+            for name, page in fetcher.pages():
+                yield name, page
+        else:
+            for name in names:
+                path, limit = self.endpoints[name]
+                for page in iter_pages(self.admin_api, path, limit):
+                    yield name, page
+                yield name, None
+
+    def fetch(self, names):
+        """Fetch and store the given endpoints.
+
+        :param names: endpoint names, see duo.api.ENDPOINTS
+        :return: number of API objects stored
+        """
+        rows = 0
+        for name, page in self.pages(names):
+            if page:
+                self.store_page(name, page)
+                rows += len(page)
+        return rows
+
+    def fetch_interleaved(self):
+        """Fetch every endpoint at once and store pages as they arrive.
+
+        User pages are held back until all Groups are stored, since the
+        user group associations reference them.
+
+        :return: number of API objects stored
+        """
+        held = []
+
+        with self.loader.tuning(), self.metrics.phase('fetch') as metrics:
+            for name, page in self.pages(
+                    ('groups', 'users', 'phones', 'tokens')):
+
+                if page is None:
+                    # All groups are stored, release the held user pages
+                    if name == 'groups':
+                        for users in held:
+                            self.store_page('users', users)
+                        held = None
+                elif name == 'users' and held is not None:
+                    held.append(page)
+                    metrics['rows'] += len(page)
+                else:
+                    self.store_page(name, page)
+                    metrics['rows'] += len(page)
+
+        self.report_phase('fetch')
+
+        return metrics['rows']
+
+    def store_page(self, name, page):
+        """Store a single page of API objects.
+
+        :param name: endpoint the page was fetched from
+        :param page: list of API objects
+        """
+        with transaction.atomic():
+            if name == 'users':
+                self.store_users(page)
+            elif name == 'groups':
+                self.record(
+                    name, upsert_groups(page, upsert=self.loader.upsert)
+                )
+            else:
+                self.store_devices(name, page)
+
+    def store_users(self, users):
+        """Store a page of Duo Users along with their phones and tokens.
+
+        Group, Phone and Token associations are collected for every
+        user and reconciled once the whole run has been fetched.
+
+        :param users: list of API user objects
+        """
+        if self.user_index is None:
+            self.user_index = dict(
+                (pk, (user_id, username, status)) for pk, user_id, username,
+                status in User.objects.values_list(
+                    'pk', 'user_id', 'username', 'status'
+                ).iterator()
+            )
+
+        result = self.record(
+            'users', upsert_users(users, upsert=self.loader.upsert)
+        )
+        user_pks = result.pks
+        self.emit_user_changes(users, result)
+
+        phone_pks = self.store_devices(
+            'phones', [phone for user in users for phone in user['phones']]
+        )
+        token_pks = self.store_devices(
+            'tokens', [token for user in users for token in user['tokens']]
+        )
+
+        self.links['phones'].update(
+            (phone_pks[phone['phone_id']], user_pks[user['user_id']])
+            for user in users for phone in user['phones']
+        )
+        self.links['tokens'].update(
+            (token_pks[token['serial']], user_pks[user['user_id']])
+            for user in users for token in user['tokens']
+        )
+
+        self.collect_groups(users, user_pks)
+
+    def store_devices(self, name, devices):
+        """Store Phones or Tokens not already stored during this run.
+
+        Devices shared by several users are only written once.
+
+        :param name: 'phones' or 'tokens'
+        :param devices: list of API phone or token objects
+        :return: dictionary of phone_id/serial -> local pk
+        """
+        key, upsert = DEVICES[name]
+        known = self.device_pks[name]
+
+        new = dict(
+            (device[key], device) for device in devices
+            if device[key] not in known
+        )
+        if new:
+            known.update(self.record(
+                name, upsert(new.values(), upsert=self.loader.upsert)
+            ).pks)
+
+        return known
+
+    def collect_groups(self, users, user_pks):
+        """Collect the Group memberships of a page of Duo Users.
+
+        Groups missing locally, e.g. created in Duo after the group
+        sync ran, are created from the group details on the user.
+
+        :param users: list of API user objects
+        :param user_pks: dictionary of user_id -> local User pk
+        """
+        if self.group_pks is None:
+            self.group_pks = dict(
+                Group.objects.values_list('group_id', 'pk')
+            )
+
+        unknown = dict(
+            (group['group_id'], group)
+            for user in users for group in user['groups']
+            if group['group_id'] not in self.group_pks
+        )
+        if unknown:
+            result = self.record('groups', upsert_groups(
+                unknown.values(), upsert=self.loader.upsert
+            ))
+            self.group_pks.update(result.pks)
+
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Created %s Duo Groups missing locally' % len(unknown)
+            )
+
+        self.links['groups'].update(
+            (self.group_pks[group['group_id']], user_pks[user['user_id']])
+            for user in users for group in user['groups']
+        )
+
+    def store_links(self):
+        """Reconcile the associations collected during the run.
+
+        :return: number of desired associations
+        """
+        for name, relation in RELATIONS:
+            added, removed = self.loader.reconcile(
+                relation, self.links[name], self.seen['users']
+            )
+            self.emit_link_changes(name, added, removed)
+
+            if name == 'groups':
+                self.changed['memberships'].update(
+                    user_pk for pk, user_pk in added | removed
+                )
+
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Duo %s links: %s added, %s removed' % (
+                    name.title(), len(added), len(removed)
+                )
+            )
+
+        return sum(len(links) for links in self.links.values())
+
+    def remove_stale(self):
+        """Remove stale local Users and orphaned devices.
+
+        These are accounts that exist in the local database
+        but are not returned from the API.  Phones and Tokens
+        left without any User are removed along with them.
+
+        :return: number of removed rows
+        :raises StaleThresholdExceeded: if too many Users look stale,
+                                        failing the run
+        """
+        stale = set(self.user_index or ()) - self.seen['users']
+
+        # Delete the local users that don't exist in the Duo database
+        deleted = self.loader.remove_stale(
+            self.seen['users'], self.max_stale_fraction
+        )
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Removed stale local User accounts (%s)' % deleted
+        )
+        self.stats['users']['deleted'] = deleted
+
+        emit([
+            self.change_event(ChangeEvent.USER_REMOVED, pk)
+            for pk in sorted(stale)
+        ])
+
+        # Delete the devices no user references anymore
+        self.stats['phones']['deleted'] = remove_orphans(
+            Phone, self.seen['phones']
+        )
+        self.stats['tokens']['deleted'] = remove_orphans(
+            Token, self.seen['tokens']
+        )
+
+        return sum(self.stats[name]['deleted'] for name in self.stats)
+
+    def update_search(self):
+        """Re-index the Users changed during the run for search.
+
+        Users are re-indexed when their own fields, their Group
+        memberships or the name of one of their Groups changed.
+
+        :return: number of re-indexed and removed Users
+        """
+        users = self.changed['users'] | self.changed['memberships']
+        if self.changed['groups']:
+            users.update(Group.users.through.objects.filter(
+                group_id__in=self.changed['groups']
+            ).values_list('user_id', flat=True))
+
+        indexed = index_users(users)
+        removed = prune_index() if self.stats['users']['deleted'] else 0
+
+        self.stdout.write(
+            self.style.WARNING('[-]') +
+            ' Updated the User search index (%s indexed, %s removed)' % (
+                indexed, removed
+            )
+        )
+
+        return indexed + removed
+
+    def change_event(self, kind, user_pk, **fields):
+        """Build a change event of this run for a User.
+
+        :param kind: ChangeEvent kind
+        :param user_pk: local pk of the User, see user_index
+        :param fields: further ChangeEvent fields
+        :return: unsaved ChangeEvent
+        """
+        user_id, username, status = self.user_index[user_pk]
+        return ChangeEvent(
+            generation=self.sync_run.pk, kind=kind, user_id=user_id,
+            username=username, **fields
+        )
+
+    def emit_user_changes(self, users, result):
+        """Emit the added and status changed events of a User page.
+
+        :param users: list of API user objects
+        :param result: Upserted tuple of the page
+        """
+        events = []
+        for user in users:
+            key = user['user_id']
+            pk = result.pks[key]
+            if key in result.created:
+                self.user_index[pk] = (key, user['username'], user['status'])
+                events.append(
+                    self.change_event(ChangeEvent.USER_ADDED, pk,
+                                      new_value=user['status'])
+                )
+            elif key in result.updated:
+                status = self.user_index[pk][2]
+                self.user_index[pk] = (key, user['username'], user['status'])
+                if status != user['status']:
+                    events.append(self.change_event(
+                        ChangeEvent.STATUS_CHANGED, pk,
+                        old_value=status, new_value=user['status']
+                    ))
+        emit(events)
+
+    def emit_link_changes(self, name, added, removed):
+        """Emit the events of reconciled User associations.
+
+        :param name: 'groups', 'phones' or 'tokens'
+        :param added: set of added (model pk, User pk) pairs
+        :param removed: set of removed (model pk, User pk) pairs
+        """
+        added_kind, removed_kind, model, key_field = LINK_EVENTS[name]
+
+        # Objects stored this run are known, look up only the others
+        known = self.group_pks if name == 'groups' else self.device_pks[name]
+        keys = dict((pk, key) for key, pk in (known or {}).items())
+        keys.update(natural_keys(model, key_field, set(
+            pk for pk, user_pk in added | removed if pk not in keys
+        )))
+        emit([
+            self.change_event(kind, user_pk, object_id=keys[pk])
+            for kind, pairs in ((added_kind, added), (removed_kind, removed))
+            for pk, user_pk in sorted(pairs)
+        ])
+
+    def record(self, name, result):
+        """Add the outcome of an upsert to the sync statistics.
+
+        :param name: endpoint name the statistics are kept under
+        :param result: Upserted tuple
+        :return: the Upserted tuple
+        """
+        self.stats[name]['inserted'] += len(result.created)
+        self.stats[name]['updated'] += len(result.updated)
+        self.stats[name]['unchanged'] += result.unchanged
+        self.seen[name].update(result.pks.values())
+        self.changed[name].update(
+            result.pks[key] for key in result.created | result.updated
+        )
+        return result
+
+    def finish(self, success, metrics_file=None, close=True, publish=True):
+        """Record the outcome and metrics of the run.
+
+        After a successful run the dashboard summary is refreshed.
+
+        :param success: whether every phase completed
+        :param metrics_file: optional .prom or .json file to write the
+                             metrics to, e.g. for the node_exporter
+                             textfile collector
+        :param close: close the API connections, False to keep them for
+                      the next run with the same client
+        :param publish: make a successful run the current cache
+                        generation, False when its data is not live yet,
+                        e.g. until a snapshot is swapped in
+        """
+        # Recompute the dashboard aggregates from the synced data
+        if success:
+            with self.metrics.phase('summary') as metrics:
+                metrics['rows'] = refresh_summary()
+            self.report_phase('summary')
+
+            pruned = prune_changes()
+            if pruned:
+                self.stdout.write(
+                    self.style.WARNING('[-]') +
+                    ' Pruned %s change events past retention' % pruned
+                )
+
+        self.metrics.finished = time.time()
+        self.metrics.rows = dict(
+            (name, dict(stats)) for name, stats in self.stats.items()
+        )
+
+        # Close the keep-alive connections left open by the run
+        pool = getattr(self.admin_api, 'pool', None)
+        if pool is not None:
+            stats = pool.stats()
+            for name in ('opened', 'reused', 'discarded'):
+                stats[name] -= self.pool_baseline[name]
+            self.metrics.connections = stats
+            if close:
+                pool.close()
+
+        self.sync_run.finished = timezone.now()
+        self.sync_run.success = success
+        self.sync_run.metrics = json.dumps(self.metrics.as_dict())
+        self.sync_run.save()
+
+        # Start a new cache generation, dropping every cached response
+        if success and publish:
+            set_last_sync(self.sync_run)
+
+        if metrics_file:
+            self.metrics.write(metrics_file, success)
+
+    def report(self):
+        """Write the per endpoint statistics of the run."""
+        for name in sorted(self.stats):
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' Duo %s: %s inserted, %s updated, %s unchanged, '
+                '%s deleted' % (
+                    name.title(),
+                    self.stats[name]['inserted'],
+                    self.stats[name]['updated'],
+                    self.stats[name]['unchanged'],
+                    self.stats[name]['deleted'],
+                )
+            )
+
+        for path, api in sorted(self.metrics.api.items()):
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' API %s: %s requests, %.2fs average, %s errors, '
+                '%s retries (%s rate limited)' % (
+                    path, api['requests'],
+                    api['latency_sum'] / api['requests']
+                    if api['requests'] else 0,
+                    api['errors'], api['retries'], api['throttled'],
+                )
+            )
+
+        if self.metrics.connections:
+            self.stdout.write(
+                self.style.WARNING('[-]') +
+                ' API connections: %(opened)s opened, %(reused)s reused, '
+                '%(discarded)s discarded' % self.metrics.connections
+            )
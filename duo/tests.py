@@ -1,3 +1,1157 @@
-from django.test import TestCase
+import copy
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import (
+    TestCase, SimpleTestCase, TransactionTestCase, override_settings
+)
+from django.utils import timezone
+
+from duo.admin import DuoModelAdmin, EstimatedCountPaginator
+from duo.api import Admin, AdaptiveLimiter
+from duo.authlogs import fetch_authlogs, prune_authlogs, CHECKPOINT
+from duo.cache import set_last_sync, sync_generation, LAST_SYNC_KEY
+from duo.changes import changes_since, prune_changes
+from duo.daemon import (
+    default_jobs, start_health_server, SyncDaemon, LOCK_RETRY
+)
+from duo.export import export_users
+from duo.fake_api import DROP, generate_tenant, make_server
+from duo.fastload import fast_load_supported, SQLITE_LOADER
+from duo.locking import sync_lock
+from duo.management.commands.sync_duo import Command as SyncCommand
+from duo.models import (
+    User, Group, Phone, Token, SyncRun, ChangeEvent, AuthLog, Checkpoint
+)
+from duo.phones import normalize_number, number_suffix, suffix_range
+from duo.summary import refresh_summary, load_summary
+from duo.sync import DuoSync, ORM_LOADER
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+class QueryPlanTests(TestCase):
+    """The hot sync and dashboard queries must not scan whole tables."""
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.query_plan(queryset)
+        self.assertTrue(
+            any('USING' in step and index in step for step in plan),
+            'Query does not use %s:\n%s' % (index, '\n'.join(plan))
+        )
+
+    def assertNoTableScan(self, queryset, table):
+        plan = self.query_plan(queryset)
+        scans = [
+            step for step in plan
+            if step.startswith('SCAN %s' % table) and 'USING' not in step
+        ]
+        self.assertFalse(
+            scans, 'Query scans %s:\n%s' % (table, '\n'.join(plan))
+        )
+
+    def test_users_by_status(self):
+        self.assertUsesIndex(
+            User.objects.filter(status='active', pk__gt=100).order_by('pk'),
+            'duo_user_status_login_idx'
+        )
+
+    def test_users_by_status_and_last_login(self):
+        self.assertUsesIndex(
+            User.objects.filter(
+                status='active',
+                last_login__gte=timezone.now() - datetime.timedelta(days=30)
+            ),
+            'duo_user_status_login_idx'
+        )
+
+    def test_users_by_last_login(self):
+        self.assertUsesIndex(
+            User.objects.filter(
+                last_login__lt=timezone.now() - datetime.timedelta(days=90)
+            ),
+            'duo_user_login_idx'
+        )
+
+    def test_users_by_username_and_email(self):
+        self.assertUsesIndex(
+            User.objects.filter(username='jsmith'), 'duo_user_username_idx'
+        )
+        self.assertUsesIndex(
+            User.objects.filter(email='jsmith@example.edu'),
+            'duo_user_email_idx'
+        )
+
+    def test_users_by_natural_key(self):
+        self.assertNoTableScan(
+            User.objects.filter(user_id__in=['DU1', 'DU2']), 'duo_user'
+        )
+
+    def test_users_by_group(self):
+        self.assertNoTableScan(
+            User.objects.filter(group__group_id='DG1'), 'duo_user'
+        )
+
+    def test_phones_by_number(self):
+        self.assertUsesIndex(
+            Phone.objects.filter(number='+12135550100'),
+            'duo_phone_number_idx'
+        )
+
+    def test_phones_by_normalized_number(self):
+        self.assertUsesIndex(
+            Phone.users.through.objects.filter(phone__e164='+12135550100'),
+            'duo_phone_e164_idx'
+        )
+        self.assertUsesIndex(
+            Phone.users.through.objects.filter(
+                phone__number_suffix__gte='0010555',
+                phone__number_suffix__lt='0010555:'
+            ),
+            'duo_phone_suffix_idx'
+        )
+
+    def test_admin_search(self):
+        for model, model_admin in admin.site._registry.items():
+            if not (isinstance(model_admin, DuoModelAdmin) and
+                    model_admin.search_fields):
+                continue
+            queryset, use_distinct = model_admin.get_search_results(
+                None, model_admin.get_queryset(None), 'jsmith 2135'
+            )
+            self.assertNoTableScan(queryset, model._meta.db_table)
+
+    def test_admin_filters(self):
+        for model, model_admin in admin.site._registry.items():
+            if not isinstance(model_admin, DuoModelAdmin):
+                continue
+            for field in model_admin.list_filter:
+                self.assertNoTableScan(
+                    model.objects.filter(**{field: 'x'}).order_by('-pk'),
+                    model._meta.db_table
+                )
+                self.assertNoTableScan(
+                    model.objects.values(field).distinct(),
+                    model._meta.db_table
+                )
+
+    def test_phone_breakdowns(self):
+        self.assertUsesIndex(
+            Phone.objects.values('platform').annotate(count=Count('pk')),
+            'duo_phone_platform_type_idx'
+        )
+        self.assertUsesIndex(
+            Phone.objects.values('type').annotate(count=Count('pk')),
+            'duo_phone_type_idx'
+        )
+
+    def test_user_memberships(self):
+        for model, column, index in (
+                (Group, 'group_id', 'duo_group_users_user_cover_idx'),
+                (Phone, 'phone_id', 'duo_phone_users_user_cover_idx'),
+                (Token, 'token_id', 'duo_token_users_user_cover_idx')):
+            self.assertUsesIndex(
+                model.users.through.objects.filter(
+                    user_id__in=[1, 2, 3]
+                ).values_list('user_id', column),
+                index
+            )
+
+    def test_orphaned_devices(self):
+        self.assertNoTableScan(
+            Phone.objects.filter(
+                pk__in=[1, 2, 3], users__isnull=True
+            ).values_list('pk'),
+            'duo_phone_users'
+        )
+
+
+@override_settings(DUO_PHONE_COUNTRY_CODE='1')
+class PhoneNumberTests(SimpleTestCase):
+
+    def test_normalize_national_numbers(self):
+        for number in ('(213) 555-0100', '213.555.0100', '1 213 555 0100'):
+            self.assertEqual(normalize_number(number), '+12135550100')
+
+    def test_normalize_international_numbers(self):
+        self.assertEqual(normalize_number('+44 20 7946 0958'),
+                         '+442079460958')
+        self.assertEqual(normalize_number('0044 20 7946 0958'),
+                         '+442079460958')
+        self.assertEqual(normalize_number('020 7946 0958', '44'),
+                         '+442079460958')
+
+    def test_normalize_invalid_numbers(self):
+        for number in (None, '', 'n/a', '555-0100', '22135550100',
+                       '+999999999999999999'):
+            self.assertIsNone(normalize_number(number), number)
+
+    def test_suffix_range(self):
+        key = number_suffix('+12135550100')
+        low, high = suffix_range('555-0100')
+        self.assertEqual(key, '0010555312')
+        self.assertTrue(low <= key < high)
+        low, high = suffix_range('555-0101')
+        self.assertFalse(low <= key < high)
+
+
+class PhoneLookupTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = get_user_model().objects.create_user(
+            'staff', password='staff', is_staff=True
+        )
+        for i, number in enumerate(('+1 (213) 555-0100', 'n/a', None)):
+            phone = Phone.objects.create(
+                phone_id='DP%s' % i, number=number,
+                e164=normalize_number(number, '1'),
+                number_suffix=number_suffix(normalize_number(number, '1'))
+            )
+            phone.users.create(user_id='DU%s' % i, username='user%s' % i)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.staff)
+
+    def lookup(self, number):
+        return self.client.get('/api/phones/lookup/', {'number': number})
+
+    def owners(self, number):
+        response = self.lookup(number)
+        self.assertEqual(response.status_code, 200)
+        return [user['user_id'] for phone in response.json()['results']
+                for user in phone['users']]
+
+    def test_lookup_by_full_number(self):
+        self.assertEqual(self.owners('+12135550100'), ['DU0'])
+        self.assertEqual(self.owners('0012135550100'), ['DU0'])
+
+    def test_lookup_by_last_digits(self):
+        self.assertEqual(self.owners('(213) 555-0100'), ['DU0'])
+        self.assertEqual(self.owners('5550100'), ['DU0'])
+        self.assertEqual(self.owners('5550101'), [])
+
+    def test_lookup_of_invalid_numbers(self):
+        for number in ('22135550100', '+999999999999999999', '555'):
+            self.assertEqual(self.lookup(number).status_code, 400, number)
+
+
+class ReadAPITests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = get_user_model().objects.create_user(
+            'staff', password='staff', is_staff=True
+        )
+        User.objects.bulk_create(
+            User(user_id='DU%02d' % i, username='user%02d' % i,
+                 status='disabled' if i % 5 == 0 else 'active')
+            for i in range(25)
+        )
+        SyncRun.objects.create(command='sync_duo', finished=timezone.now(),
+                               success=True)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.staff)
+
+    def test_keyset_next(self):
+        user_ids = []
+        url = '/api/users/?status=active&limit=7'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page['results']), 7)
+            user_ids.extend(user['user_id'] for user in page['results'])
+            url = page['next']
+            if url:
+                self.assertIn('status=active', url)
+                self.assertIn('after=%s' % page['results'][-1]['id'], url)
+
+        self.assertEqual(user_ids, list(User.objects.filter(
+            status='active'
+        ).order_by('pk').values_list('user_id', flat=True)))
+
+    def test_etag(self):
+        response = self.client.get('/api/users/')
+        etag = response['ETag']
+
+        response = self.client.get('/api/users/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A new sync changes the ETag of every page
+        set_last_sync(SyncRun.objects.create(
+            command='sync_duo', finished=timezone.now(), success=True
+        ))
+        response = self.client.get('/api/users/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_bad_parameters(self):
+        for params in ({'last_login_after': 'yesterday'},
+                       {'last_login_before': '2020-13-01'},
+                       {'limit': 'ten'}):
+            response = self.client.get('/api/users/', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn(list(params)[0], response.json()['error'])
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'admin', 'admin@example.edu', 'admin'
+        ))
+
+    def test_search_help_text(self):
+        response = self.client.get('/admin/duo/user/', {'q': 'JSmith'})
+        self.assertContains(
+            response, 'Case sensitive, matches the username or email '
+                      'starting with, or user id equal to each term.'
+        )
+
+        response = self.client.get('/admin/duo/changeevent/')
+        self.assertNotContains(response, 'Case sensitive')
+
+
+class SummaryTests(TestCase):
+
+    def test_null_and_empty_values_share_a_key(self):
+        Phone.objects.create(phone_id='DP1', platform=None, type='')
+        Phone.objects.create(phone_id='DP2', platform='', type=None)
+        Phone.objects.create(phone_id='DP3', platform='Apple iOS',
+                             type='Mobile')
+
+        refresh_summary()
+
+        summary = load_summary()
+        self.assertEqual(dict(summary['phones_by_platform']),
+                         {'none': 2, 'Apple iOS': 1})
+        self.assertEqual(dict(summary['phones_by_type']),
+                         {'none': 2, 'Mobile': 1})
+
+    def test_groups_sharing_a_name(self):
+        user = User.objects.create(user_id='DU1', username='user1')
+        Group.objects.create(group_id='DG1', name='Staff').users.add(user)
+        Group.objects.create(group_id='DG2', name='Staff')
+
+        refresh_summary()
+
+        self.assertEqual(dict(load_summary()['group_sizes']),
+                         {'DG1': 1, 'DG2': 0})
+
+
+def tenant_state(tenant):
+    """Return the local state a sync of a fake tenant must end in."""
+    users = tenant['users']
+    return {
+        'users': set((user['user_id'], user['status']) for user in users),
+        'groups': set((group['group_id'], user['user_id'])
+                      for user in users for group in user['groups']),
+        'phones': set((phone['phone_id'], user['user_id'])
+                      for user in users for phone in user['phones']),
+        'tokens': set((token['serial'], user['user_id'])
+                      for user in users for token in user['tokens']),
+        'devices': set(
+            [phone['phone_id'] for phone in tenant['phones']] +
+            [token['serial'] for token in tenant['tokens']]
+        ),
+    }
+
+
+def local_state():
+    """Return the synced local state, comparable to tenant_state."""
+    def pairs(model, key):
+        return set(model.users.through.objects.values_list(
+            model.__name__.lower() + '__' + key, 'user__user_id'
+        ))
+
+    return {
+        'users': set(User.objects.values_list('user_id', 'status')),
+        'groups': pairs(Group, 'group_id'),
+        'phones': pairs(Phone, 'phone_id'),
+        'tokens': pairs(Token, 'serial'),
+        'devices': set(
+            list(Phone.objects.values_list('phone_id', flat=True)) +
+            list(Token.objects.values_list('serial', flat=True))
+        ),
+    }
+
+
+def remove_user(tenant, user):
+    """Remove a user from a fake tenant, with the devices only it used."""
+    tenant['users'].remove(user)
+    for name in ('phones', 'tokens'):
+        for device in tenant[name]:
+            device['users'] = [
+                owner for owner in device['users']
+                if owner['user_id'] != user['user_id']
+            ]
+        tenant[name] = [device for device in tenant[name] if device['users']]
+
+
+class FakeAPIMixin(object):
+    """Serve a fresh synthetic tenant from the fake Admin API per test."""
+
+    loader = ORM_LOADER
+    workers = 1
+
+    @classmethod
+    def setUpClass(cls):
+        super(FakeAPIMixin, cls).setUpClass()
+        cls.server = make_server(None)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmpdir)
+        super(FakeAPIMixin, cls).tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.server.fail_pages.clear()
+        self.server.faults.clear()
+        self.tenant = self.server.tenant = copy.deepcopy(
+            generate_tenant(50, seed=1)
+        )
+
+    def admin_api(self):
+        admin_api = Admin('test', 'test', '127.0.0.1', ca_certs='HTTP')
+        admin_api.port = self.server.server_port
+        return admin_api
+
+    def api_settings(self):
+        """Point the management commands at the fake Admin API."""
+        return override_settings(
+            DUO_IKEY='test', DUO_SKEY='test', DUO_CA_CERTS='HTTP',
+            DUO_HOST='127.0.0.1:%s' % self.server.server_port,
+            DUO_SYNC_LOCK_FILE=os.path.join(self.tmpdir, 'sync.lock')
+        )
+
+    def sync(self, phases=DuoSync.PHASES, **options):
+        options.setdefault('workers', self.workers)
+        sync = DuoSync(self.admin_api(), SyncCommand(stdout=io.StringIO()),
+                       loader=self.loader, **options)
+        with sync.finishing():
+            sync.run(phases)
+        return sync
+
+
+class SyncScenarios(FakeAPIMixin):
+    """Sync a tenant served by the fake Admin API and check the result."""
+
+    def counts(self, sync, name):
+        stats = sync.stats[name]
+        return (stats['inserted'], stats['updated'], stats['unchanged'],
+                stats['deleted'])
+
+    def test_initial_sync(self):
+        sync = self.sync()
+
+        self.assertEqual(local_state(), tenant_state(self.tenant))
+        self.assertEqual(self.counts(sync, 'users'), (50, 0, 0, 0))
+        self.assertTrue(sync.sync_run.success)
+
+    def test_unchanged_resync(self):
+        self.sync()
+        sync = self.sync()
+
+        self.assertEqual(local_state(), tenant_state(self.tenant))
+        self.assertEqual(self.counts(sync, 'users'), (0, 0, 50, 0))
+        self.assertEqual(self.counts(sync, 'groups')[:2], (0, 0))
+        self.assertFalse(sync.changed['memberships'])
+
+    def test_resync_of_changes(self):
+        self.sync()
+        tokens = len(self.tenant['tokens'])
+
+        users = self.tenant['users']
+        users[0]['status'] = 'disabled'
+        leaver = next(user for user in users[1:] if user['groups'])
+        leaver['groups'].pop()
+        holder = next(user for user in users[1:] if user['tokens'])
+        revoked = holder['tokens'].pop()
+        self.tenant['tokens'].remove(next(
+            token for token in self.tenant['tokens']
+            if token['serial'] == revoked['serial']
+        ))
+        remove_user(self.tenant, users[-1])
+
+        sync = self.sync()
+
+        self.assertEqual(local_state(), tenant_state(self.tenant))
+        self.assertEqual(self.counts(sync, 'users'), (0, 1, 48, 1))
+        self.assertEqual(self.counts(sync, 'tokens')[3],
+                         tokens - len(self.tenant['tokens']))
+        self.assertIn(User.objects.get(user_id=leaver['user_id']).pk,
+                      sync.changed['memberships'])
+
+    def test_stale_threshold(self):
+        self.sync()
+        for user in self.tenant['users'][:10]:
+            remove_user(self.tenant, user)
+
+        with self.assertRaisesMessage(CommandError, 'StaleThresholdExceeded'):
+            self.sync(max_stale_fraction=0.1)
+
+        self.assertEqual(User.objects.count(), 50)
+        self.assertEqual(
+            list(SyncRun.objects.values_list('success', flat=True)),
+            [True, False]
+        )
+
+
+class SyncTests(SyncScenarios, TestCase):
+
+    @mock.patch('duo.management.base.fast_load_supported', return_value=False)
+    def test_fast_unsupported(self, fast_load_supported):
+        for name in ('fetch_duo_groups', 'fetch_duo_users', 'sync_duo',
+                     'duo_sync_daemon'):
+            with self.api_settings():
+                with self.assertRaisesMessage(CommandError, '--fast'):
+                    call_command(name, '--fast', stdout=io.StringIO())
+
+        self.assertFalse(SyncRun.objects.exists())
+
+    def test_stale_threshold_fails_command(self):
+        self.sync()
+        for user in self.tenant['users'][:10]:
+            remove_user(self.tenant, user)
+
+        with self.api_settings():
+            with self.assertRaisesMessage(CommandError, 'look stale'):
+                call_command('sync_duo', '--max-stale-fraction', '0.1',
+                             stdout=io.StringIO())
+
+        self.assertEqual(User.objects.count(), 50)
+        self.assertFalse(SyncRun.objects.latest('pk').success)
+
+
+class ConcurrentSyncTests(SyncScenarios, TestCase):
+    """Run the sync tests with the pages fetched by several workers."""
+
+    workers = 4
+
+    def sync(self, **options):
+        # Small user pages, so every worker fetches some of them
+        options.setdefault('page_size', 7)
+        return super(ConcurrentSyncTests, self).sync(**options)
+
+    def test_interleaved_fetch(self):
+        with self.api_settings():
+            call_command('fetch_duo_users', '--concurrent', '--workers', '4',
+                         '--page-size', '7', stdout=io.StringIO())
+
+        self.assertEqual(local_state(), tenant_state(self.tenant))
+        self.assertTrue(SyncRun.objects.get().success)
+
+    def test_failed_worker(self):
+        self.server.fail_pages.add(('users', 21))
+        admin_api = self.admin_api()
+        admin_api.max_retries = 0
+
+        sync = DuoSync(admin_api, SyncCommand(stdout=io.StringIO()),
+                       workers=4, page_size=7)
+        with self.assertRaises(CommandError):
+            with sync.finishing():
+                sync.run()
+
+        self.assertIs(sync.sync_run.success, False)
+        self.assertFalse(User.objects.exists())
+        self.assertIsNone(admin_api.limiter)
+        self.assertFalse([
+            thread for thread in threading.enumerate()
+            if thread.name.startswith('ThreadPoolExecutor')
+        ])
+
+
+@unittest.skipUnless(fast_load_supported(), 'SQLite merge loader')
+class FastSyncTests(SyncScenarios, TransactionTestCase):
+    """Run the sync tests with the SQLite merge loader.
+
+    The loader changes PRAGMAs that SQLite refuses to change inside the
+    transaction a TestCase wraps each test in.
+    """
+
+    loader = SQLITE_LOADER
+
+    def test_loader_parity(self):
+        def scenario():
+            self.tenant = self.server.tenant = copy.deepcopy(
+                generate_tenant(50, seed=1)
+            )
+            self.sync()
+            users = self.tenant['users']
+            users[0]['status'] = 'disabled'
+            next(user for user in users if user['groups'])['groups'].pop()
+            remove_user(self.tenant, users[-1])
+            sync = self.sync()
+            return local_state(), dict(
+                (name, self.counts(sync, name)) for name in sync.stats
+            )
+
+        self.loader = ORM_LOADER
+        expected = scenario()
+        for model in (User, Group, Phone, Token):
+            model.objects.all().delete()
+
+        self.loader = SQLITE_LOADER
+        self.assertEqual(scenario(), expected)
+
+
+@contextmanager
+def file_database(path):
+    """Run the block against a migrated SQLite database file.
+
+    The connection to the in-memory test database is kept aside rather
+    than closed, since closing it would drop the database.
+    """
+    saved = connection.connection, connection.settings_dict['NAME']
+    connection.connection = None
+    connection.settings_dict['NAME'] = path
+    try:
+        call_command('migrate', verbosity=0)
+        yield
+    finally:
+        connection.close()
+        connection.connection, connection.settings_dict['NAME'] = saved
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite snapshots')
+class SnapshotTests(FakeAPIMixin, TransactionTestCase):
+    """Snapshot syncs against a live database file."""
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.database = file_database(
+            os.path.join(self.tmpdir, '%s.db' % self._testMethodName)
+        )
+        self.database.__enter__()
+        self.addCleanup(self.database.__exit__, None, None, None)
+
+    def snapshot_sync(self):
+        with self.api_settings():
+            call_command('sync_duo', '--snapshot', '--workers', '1',
+                         stdout=io.StringIO())
+
+    def test_swap_in(self):
+        self.snapshot_sync()
+
+        self.assertEqual(local_state(), tenant_state(self.tenant))
+        sync_run = SyncRun.objects.get()
+        self.assertTrue(sync_run.success)
+        self.assertEqual(sync_generation(), sync_run.pk)
+        self.assertEqual(
+            set(ChangeEvent.objects.values_list('generation', flat=True)),
+            {sync_run.pk}
+        )
+
+    def test_history_is_appended(self):
+        self.snapshot_sync()
+        events = ChangeEvent.objects.count()
+        self.tenant['users'][0]['status'] = 'disabled'
+
+        self.snapshot_sync()
+
+        self.assertEqual(SyncRun.objects.filter(success=True).count(), 2)
+        self.assertEqual(ChangeEvent.objects.count(), events + 1)
+
+    def test_rollback(self):
+        self.snapshot_sync()
+        expected = local_state()
+        remove_user(self.tenant, self.tenant['users'][-1])
+        self.tenant['users'][0]['status'] = 'disabled'
+        self.snapshot_sync()
+        generation = sync_generation()
+
+        with self.api_settings():
+            call_command('rollback_duo', stdout=io.StringIO())
+
+        self.assertEqual(local_state(), expected)
+        self.assertEqual(SyncRun.objects.count(), 3)
+        self.assertGreater(sync_generation(), generation)
+
+    def test_failed_run_keeps_live_data(self):
+        self.snapshot_sync()
+        expected = local_state()
+        self.tenant['users'][0]['status'] = 'disabled'
+        self.server.fail_pages.add(('users', 0))
+
+        with mock.patch.object(Admin, 'max_retries', 0):
+            with self.assertRaises(CommandError):
+                self.snapshot_sync()
+
+        self.assertEqual(local_state(), expected)
+        self.assertEqual(
+            list(SyncRun.objects.values_list('success', flat=True)),
+            [True, False]
+        )
+
+
+class AuthLogTests(FakeAPIMixin, TestCase):
+    """Fetch the fake authentication log, one event per second."""
+
+    def fetch(self, now):
+        return fetch_authlogs(self.admin_api(), initial_days=0.01, limit=100,
+                              now=now)
+
+    def test_incremental_fetch(self):
+        now = 1500000000
+        fetched, inserted = self.fetch(now)
+        first = Checkpoint.objects.get(name=CHECKPOINT).mintime
+
+        self.assertEqual((fetched, inserted), (745, 745))
+
+        fetched, inserted = self.fetch(now + 300)
+        second = Checkpoint.objects.get(name=CHECKPOINT).mintime
+
+        # The event at the checkpoint is read again, but not stored twice
+        self.assertEqual((fetched, inserted), (301, 300))
+        self.assertEqual(second, first + 300 * 1000)
+        self.assertEqual(AuthLog.objects.count(), 1045)
+        self.assertEqual(
+            AuthLog.objects.values('txid').distinct().count(), 1045
+        )
+
+    def test_estimated_count_after_pruning(self):
+        now = timezone.now()
+        AuthLog.objects.bulk_create(
+            AuthLog(txid='TX%s' % i,
+                    timestamp=now - datetime.timedelta(days=60 - i))
+            for i in range(60)
+        )
+        prune_authlogs(days=30)
+
+        paginator = EstimatedCountPaginator(
+            AuthLog.objects.order_by('pk'), 100
+        )
+        self.assertEqual(paginator.count, AuthLog.objects.count())
+
+
+@mock.patch('duo.api.time.sleep')
+class RetryTests(FakeAPIMixin, TestCase):
+    """Retry requests failed by the fake Admin API."""
+
+    def list_users(self, admin_api):
+        return admin_api.json_api_call(
+            'GET', '/admin/v1/users', {'limit': '10', 'offset': '0'}
+        )
+
+    def test_retry(self, sleep):
+        self.server.faults.extend([DROP, 429, 503])
+        requests = self.server.requests
+
+        users = self.list_users(self.admin_api())
+
+        self.assertEqual(len(users), 10)
+        self.assertEqual(sleep.call_count, 3)
+        self.assertEqual(self.server.requests - requests, 4)
+
+    def test_stale_connection_is_replaced(self, sleep):
+        admin_api = self.admin_api()
+        self.list_users(admin_api)
+        self.server.faults.append(DROP)
+
+        self.list_users(admin_api)
+
+        # A dropped keep-alive connection is reopened without a retry
+        self.assertEqual(sleep.call_count, 0)
+        self.assertEqual(admin_api.pool.stats()['discarded'], 1)
+
+    def test_retries_exhausted(self, sleep):
+        admin_api = self.admin_api()
+        admin_api.max_retries = 2
+        self.server.faults.extend([503] * 3)
+
+        with self.assertRaises(RuntimeError):
+            self.list_users(admin_api)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_backoff(self, sleep):
+        admin_api = self.admin_api()
+        retry_after = mock.Mock(**{'getheader.return_value': '40'})
+
+        for attempt in range(12):
+            delay = admin_api.backoff(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(
+                delay, min(admin_api.backoff_max, 0.5 * 2 ** attempt)
+            )
+        self.assertGreaterEqual(admin_api.backoff(0, retry_after), 40)
+
+    def test_limiter(self, sleep):
+        limiter = AdaptiveLimiter(4)
+
+        for limit in (2, 1, 1):
+            limiter.acquire()
+            limiter.release(throttled=True)
+            self.assertEqual(limiter.limit, limit)
+
+        # Grows back by one for every limit successful requests
+        for limit in (2, 2.5, 2.9):
+            limiter.acquire()
+            limiter.release()
+            self.assertAlmostEqual(limiter.limit, limit)
+        for i in range(20):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 4)
+
+    def test_network_error_fails_run(self, sleep):
+        self.server.faults.extend([DROP] * 2)
+
+        with mock.patch.object(Admin, 'max_retries', 1):
+            with self.assertRaises(CommandError):
+                self.sync()
+
+        run = SyncRun.objects.get()
+        self.assertFalse(run.success)
+        self.assertIsNotNone(run.finished)
+
+
+class ChangeFeedTests(FakeAPIMixin, TestCase):
+    """Follow the change events emitted by syncs of the fake tenant."""
+
+    def setUp(self):
+        super(ChangeFeedTests, self).setUp()
+        self.client.force_login(get_user_model().objects.create_user(
+            'staff', password='staff', is_staff=True
+        ))
+
+    def events(self, generation, *kinds):
+        return set(ChangeEvent.objects.filter(
+            generation=generation, kind__in=kinds
+        ).values_list('kind', 'user_id', 'old_value', 'new_value'))
+
+    def test_resync_events(self):
+        first = self.sync().sync_run.pk
+        users = self.tenant['users']
+
+        self.assertEqual(
+            len(self.events(first, ChangeEvent.USER_ADDED)), len(users)
+        )
+
+        changed, removed = users[0], users[-1]
+        status = changed['status']
+        changed['status'] = 'locked out' if status == 'active' else 'active'
+        added = dict(copy.deepcopy(users[1]), user_id='DUADDED',
+                     username='added', groups=[], phones=[], tokens=[])
+        users.append(added)
+        remove_user(self.tenant, removed)
+
+        second = self.sync().sync_run.pk
+
+        self.assertEqual(self.events(
+            second, ChangeEvent.USER_ADDED, ChangeEvent.STATUS_CHANGED,
+            ChangeEvent.USER_REMOVED
+        ), {
+            (ChangeEvent.USER_ADDED, 'DUADDED', None, added['status']),
+            (ChangeEvent.STATUS_CHANGED, changed['user_id'], status,
+             changed['status']),
+            (ChangeEvent.USER_REMOVED, removed['user_id'], None, None),
+        })
+        self.assertEqual(
+            set(changes_since(first).values_list('generation', flat=True)),
+            {second}
+        )
+
+    def test_cursor_paging(self):
+        self.sync()
+        users = self.tenant['users']
+        for user in users[:5]:
+            user['status'] = 'disabled' if user['status'] == 'active' \
+                else 'active'
+        remove_user(self.tenant, users[-1])
+        self.sync()
+
+        ids = []
+        url = '/api/changes/?limit=7'
+        while url:
+            response = self.client.get(url).json()
+            ids.extend(event['id'] for event in response['results'])
+            url = response['next']
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(
+            ids, list(ChangeEvent.objects.values_list('pk', flat=True))
+        )
+
+    def test_prune_keeps_window(self):
+        old, recent = self.sync().sync_run, self.sync().sync_run
+        SyncRun.objects.filter(pk=old.pk).update(
+            started=timezone.now() - datetime.timedelta(days=31)
+        )
+        ChangeEvent.objects.create(generation=recent.pk,
+                                   kind=ChangeEvent.USER_REMOVED,
+                                   user_id='DUGONE', username='gone')
+        pruned = ChangeEvent.objects.filter(generation=old.pk).count()
+        kept = ChangeEvent.objects.count() - pruned
+
+        self.assertEqual(prune_changes(days=30), pruned)
+        self.assertEqual(ChangeEvent.objects.count(), kept)
+        self.assertFalse(ChangeEvent.objects.filter(generation=old.pk))
+
+
+class CacheGenerationTests(FakeAPIMixin, TestCase):
+    """Serve cached API responses only until the next sync."""
+
+    def setUp(self):
+        super(CacheGenerationTests, self).setUp()
+        self.client.force_login(get_user_model().objects.create_user(
+            'staff', password='staff', is_staff=True
+        ))
+
+    def statuses(self):
+        response = self.client.get('/api/users/', {'limit': 1000})
+        self.assertEqual(response.status_code, 200)
+        return dict((user['user_id'], user['status'])
+                    for user in response.json()['results'])
+
+    def change_status(self):
+        user = self.tenant['users'][0]
+        user['status'] = 'disabled' if user['status'] == 'active' \
+            else 'active'
+        return user
+
+    def test_sync_starts_generation(self):
+        self.sync()
+        self.assertEqual(set(self.statuses().items()),
+                         tenant_state(self.tenant)['users'])
+
+        user = self.change_status()
+        self.sync()
+
+        self.assertEqual(self.statuses()[user['user_id']], user['status'])
+
+    def test_sync_by_other_process(self):
+        self.sync()
+        self.statuses()
+
+        # A sync in another process only shows up in the database
+        user = self.change_status()
+        with mock.patch('duo.sync.set_last_sync'):
+            self.sync()
+        self.assertNotEqual(self.statuses()[user['user_id']], user['status'])
+
+        # Noticed once the cached SyncRun expires after GENERATION_TTL
+        cache.delete(LAST_SYNC_KEY)
+        self.assertEqual(self.statuses()[user['user_id']], user['status'])
+
+
+class LockTests(FakeAPIMixin, TestCase):
+    """Keep syncs from overlapping and report on the sync daemon."""
+
+    def daemon(self):
+        return SyncDaemon(
+            self.admin_api(), SyncCommand(stdout=io.StringIO()),
+            default_jobs(), sync_options={'workers': 1, 'loader': self.loader}
+        )
+
+    def test_held_lock_fails_command(self):
+        with self.api_settings(), sync_lock():
+            with self.assertRaises(CommandError):
+                call_command('sync_duo', stdout=io.StringIO())
+
+        self.assertFalse(SyncRun.objects.exists())
+
+    def test_held_lock_delays_job(self):
+        daemon = self.daemon()
+        job = daemon.jobs[0]
+
+        with self.api_settings():
+            with sync_lock():
+                daemon.run_job(job)
+            self.assertEqual(job.runs, 0)
+            self.assertAlmostEqual(job.next_run, time.time() + LOCK_RETRY,
+                                   delta=5)
+
+            daemon.run_job(job)
+
+        self.assertEqual((job.runs, job.failures), (1, 0))
+        self.assertIsNotNone(job.last_success)
+        self.assertAlmostEqual(job.next_run, time.time() + job.interval,
+                               delta=job.interval * job.jitter + 5)
+
+    @mock.patch('duo.api.time.sleep')
+    def test_failed_job_is_rescheduled(self, sleep):
+        daemon = self.daemon()
+        job = daemon.jobs[0]
+        self.server.faults.append(DROP)
+
+        with self.api_settings(), mock.patch.object(Admin, 'max_retries', 0):
+            daemon.run_job(job)
+
+        self.assertEqual((job.runs, job.failures), (1, 1))
+        self.assertIn('RemoteDisconnected', job.last_error)
+        self.assertGreater(job.next_run, time.time() + LOCK_RETRY)
+        self.assertFalse(SyncRun.objects.get().success)
+
+    def get_health(self, server):
+        url = 'http://127.0.0.1:%s/health' % server.server_port
+        try:
+            response = urllib.request.urlopen(url)
+        except urllib.error.HTTPError as e:
+            response = e
+        return response.status, json.loads(response.read().decode('utf-8'))
+
+    def test_health(self):
+        daemon = self.daemon()
+        server = start_health_server(daemon)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        status, body = self.get_health(server)
+        self.assertEqual(status, 200)
+        self.assertEqual(set(body['jobs']), {'groups', 'users', 'devices'})
+
+        # A job without a success for STALE_INTERVALS turns unhealthy
+        job = daemon.jobs[1]
+        job.created -= 4 * job.interval
+        status, body = self.get_health(server)
+        self.assertEqual(status, 503)
+        self.assertFalse(body['jobs']['users']['healthy'])
+
+
+@mock.patch('duo.api.time.sleep')
+class ConnectionPoolTests(FakeAPIMixin, TestCase):
+    """Reuse keep-alive connections to the fake Admin API."""
+
+    def test_reuse(self, sleep):
+        requests = self.server.requests
+
+        stats = self.sync().admin_api.pool.stats()
+
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], self.server.requests - requests - 1)
+
+    def test_dropped_connection(self, sleep):
+        # The server closes the kept alive connection in the middle of
+        # the run, the next request reconnects without a retry
+        self.server.faults.extend([None, None, DROP])
+
+        sync = self.sync()
+        stats = sync.admin_api.pool.stats()
+
+        self.assertFalse(self.server.faults)
+        self.assertEqual(local_state(), tenant_state(self.tenant))
+        self.assertEqual((stats['opened'], stats['discarded']), (2, 1))
+        self.assertFalse(sleep.called)
+
+    def test_idle_timeout(self, sleep):
+        admin_api = Admin('test', 'test', '127.0.0.1', ca_certs='HTTP',
+                          idle_timeout=0)
+        admin_api.port = self.server.server_port
+
+        for i in range(3):
+            admin_api.json_api_call('GET', '/admin/v1/groups', {})
+
+        self.assertEqual(admin_api.pool.stats(), {
+            'opened': 3, 'reused': 0, 'discarded': 2, 'idle': 1
+        })
+
+
+class ExportTests(FakeAPIMixin, TestCase):
+    """Export a synced tenant and read the export back."""
+
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        self.sync()
+
+    def expected(self, name, key):
+        return dict(
+            (user['user_id'], sorted(item[key] for item in user[name]))
+            for user in self.tenant['users']
+        )
+
+    def test_ndjson(self):
+        chunks = list(export_users('ndjson', chunk_size=7))
+        users = [json.loads(line) for chunk in chunks
+                 for line in chunk.splitlines()]
+
+        self.assertEqual(len(chunks), 8)
+        self.assertEqual([user['id'] for user in users],
+                         sorted(user['id'] for user in users))
+        self.assertEqual(
+            set((user['user_id'], user['status']) for user in users),
+            tenant_state(self.tenant)['users']
+        )
+        for name, key in (('groups', 'group_id'), ('phones', 'phone_id'),
+                          ('tokens', 'serial')):
+            self.assertEqual(dict(
+                (user['user_id'], sorted(item[key] for item in user[name]))
+                for user in users
+            ), self.expected(name, key))
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(
+            ''.join(export_users('csv', chunk_size=7))
+        )))
+
+        self.assertEqual(
+            set((row['user_id'], row['status']) for row in rows),
+            tenant_state(self.tenant)['users']
+        )
+        for name, key in (('groups', 'name'), ('tokens', 'serial')):
+            self.assertEqual(dict(
+                (row['user_id'], sorted(filter(None, row[name].split(';'))))
+                for row in rows
+            ), self.expected(name, key))
+
+    def test_chunk_size(self):
+        for format in ('csv', 'ndjson'):
+            whole = ''.join(export_users(format))
+            for chunk_size in (1, 7, 49, 50):
+                self.assertEqual(
+                    ''.join(export_users(format, chunk_size=chunk_size)),
+                    whole
+                )
+
+    def test_gzip(self):
+        plain = ''.join(export_users('ndjson', chunk_size=7))
+        compressed = b''.join(export_users('ndjson', True, chunk_size=7))
+        self.assertEqual(gzip.decompress(compressed).decode('utf-8'), plain)
+
+        path = os.path.join(self.tmpdir, 'users.csv.gz')
+        call_command('export_duo', '--output', path, '--chunk-size', '7')
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+            self.assertEqual(f.read(), ''.join(export_users('csv')))
+
+        self.client.force_login(get_user_model().objects.create_user(
+            'staff', password='staff', is_staff=True
+        ))
+        response = self.client.get('/api/users/export/',
+                                   {'format': 'ndjson', 'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(
+            b''.join(response.streaming_content)
+        ).decode('utf-8'), plain)
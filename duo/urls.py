@@ -0,0 +1,17 @@
+from django.urls import path
+
+from duo import views
+
+app_name = 'duo'
+
+urlpatterns = [
+    path('users/', views.users, name='users'),
+    path('users/search/', views.search, name='search'),
+    path('users/export/', views.export, name='export'),
+    path('groups/', views.groups, name='groups'),
+    path('phones/', views.phones, name='phones'),
+    path('phones/lookup/', views.phone_lookup, name='phone_lookup'),
+    path('tokens/', views.tokens, name='tokens'),
+    path('summary/', views.summary, name='summary'),
+    path('changes/', views.changes, name='changes'),
+]
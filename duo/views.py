@@ -1,3 +1,436 @@
-from django.shortcuts import render
+import datetime
+import hashlib
+from functools import wraps
 
-# Create your views here.
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count, Prefetch, prefetch_related_objects
+from django.http import JsonResponse, QueryDict, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.http import condition, require_GET
+
+from duo import cache
+from duo.changes import changes_since, serialize_event
+from duo.export import export_users, FORMATS, CONTENT_TYPES
+from duo.phones import (
+    digits, normalize_number, suffix_range, MIN_LOOKUP_DIGITS, SUFFIX_DIGITS
+)
+from duo.models import User, Group, Phone, Token
+from duo.search import search_users, SEARCH_LIMIT, MAX_SEARCH_LIMIT
+from duo.summary import get_summary
+
+
+# Default and largest number of objects returned per page
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Largest number of (Phone, User) pairs returned by a number lookup
+LOOKUP_LIMIT = 100
+
+
+class BadRequest(ValueError):
+    """Raised for invalid query parameters, answered with a 400."""
+
+
+def last_sync(request):
+    """Return the last successful SyncRun, None before the first sync.
+
+    The result is kept on the request, since the ETag and Last-Modified
+    conditions and the view itself all need the same SyncRun.
+    """
+    if not hasattr(request, '_duo_last_sync'):
+        request._duo_last_sync = cache.last_sync()
+    return request._duo_last_sync
+
+
+def sync_etag(request, *args, **kwargs):
+    # Data only changes with a sync, so a sync and URL identify a page
+    sync_run = last_sync(request)
+    if sync_run is None:
+        return None
+    return hashlib.sha1(
+        ('%s:%s' % (sync_run.pk, request.get_full_path())).encode('utf-8')
+    ).hexdigest()
+
+
+def sync_last_modified(request, *args, **kwargs):
+    sync_run = last_sync(request)
+    return sync_run and sync_run.finished
+
+
+def read_api(view):
+    """Decorate a read API view.
+
+    Only staff may GET the view, conditional requests are answered
+    with a 304 while no sync has run since, other responses are cached
+    until the next sync and a BadRequest becomes a 400 response.
+    """
+    view = condition(
+        etag_func=sync_etag, last_modified_func=sync_last_modified
+    )(cache.cache_response(view))
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    return require_GET(staff_member_required(wrapper))
+
+
+def get_datetime(request, name):
+    """Parse an ISO 8601 date or datetime query parameter.
+
+    :param request: HttpRequest
+    :param name: query parameter name
+    :return: aware datetime, None if the parameter is missing
+    :raises BadRequest: if the parameter is not a date or datetime
+    """
+    value = request.GET.get(name)
+    if not value:
+        return None
+
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            date = parse_date(value)
+            if date is not None:
+                parsed = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        parsed = None
+
+    if parsed is None:
+        raise BadRequest('%s must be an ISO 8601 date or datetime' % name)
+
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def get_int(request, name, default=None):
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest('%s must be an integer' % name)
+
+
+def paginate(request, queryset, serialize):
+    """Return a page of a queryset using keyset pagination on the pk.
+
+    Pages are selected with pk > after rather than an OFFSET, so every
+    page costs the same no matter how deep into the result set it is.
+
+    :param request: HttpRequest with optional after and limit parameters
+    :param queryset: filtered QuerySet
+    :param serialize: function turning a model instance into a dictionary
+    :return: JsonResponse with the results and the URL of the next page
+    """
+    limit = min(max(get_int(request, 'limit', PAGE_SIZE), 1),
+                MAX_PAGE_SIZE)
+    after = get_int(request, 'after', 0)
+
+    # Fetch one extra row to know whether there is a next page
+    rows = list(queryset.filter(pk__gt=after).order_by('pk')[:limit + 1])
+
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = QueryDict(mutable=True)
+        params.update(request.GET)
+        params['after'] = rows[-1].pk
+        params['limit'] = limit
+        next_url = '%s?%s' % (request.path, params.urlencode())
+
+    sync_run = last_sync(request)
+    return JsonResponse({
+        'results': [serialize(row) for row in rows],
+        'next': next_url,
+        'synced': sync_run and sync_run.finished,
+    })
+
+
+def brief_user(user):
+    return {'user_id': user.user_id, 'username': user.username}
+
+
+def serialize_user(user):
+    return {
+        'id': user.pk,
+        'user_id': user.user_id,
+        'username': user.username,
+        'email': user.email,
+        'status': user.status,
+        'realname': user.realname,
+        'notes': user.notes,
+        'last_login': user.last_login,
+        'groups': [
+            {'group_id': group.group_id, 'name': group.name}
+            for group in user.group_set.all()
+        ],
+        'phones': [
+            {'phone_id': phone.phone_id, 'number': phone.number}
+            for phone in user.phone_set.all()
+        ],
+        'tokens': [
+            {'serial': token.serial, 'type': token.type}
+            for token in user.token_set.all()
+        ],
+    }
+
+
+def serialize_group(group):
+    return {
+        'id': group.pk,
+        'group_id': group.group_id,
+        'name': group.name,
+        'desc': group.desc,
+        'status': group.status,
+        'mobile_otp_enabled': group.mobile_otp_enabled,
+        'push_enabled': group.push_enabled,
+        'sms_enabled': group.sms_enabled,
+        'voice_enabled': group.voice_enabled,
+        'user_count': group.user_count,
+    }
+
+
+def serialize_phone(phone):
+    return {
+        'id': phone.pk,
+        'phone_id': phone.phone_id,
+        'name': phone.name,
+        'number': phone.number,
+        'extension': phone.extension,
+        'type': phone.type,
+        'platform': phone.platform,
+        'postdelay': phone.postdelay,
+        'predelay': phone.predelay,
+        'sms_passcodes_sent': phone.sms_passcodes_sent,
+        'activated': phone.activated,
+        'e164': phone.e164,
+        'users': [brief_user(user) for user in phone.users.all()],
+    }
+
+
+def serialize_token(token):
+    return {
+        'id': token.pk,
+        'serial': token.serial,
+        'token_id': token.token_id,
+        'type': token.type,
+        'totp_step': token.totp_step,
+        'users': [brief_user(user) for user in token.users.all()],
+    }
+
+
+# Only the fields the serializers need are loaded for related rows
+BRIEF_USERS = Prefetch(
+    'users', queryset=User.objects.only('user_id', 'username')
+)
+USER_RELATIONS = (
+    Prefetch('group_set',
+             queryset=Group.objects.only('group_id', 'name')),
+    Prefetch('phone_set',
+             queryset=Phone.objects.only('phone_id', 'number')),
+    Prefetch('token_set',
+             queryset=Token.objects.only('serial', 'type')),
+)
+
+
+@read_api
+def users(request):
+    """List Duo Users.
+
+    Filters: status, group (group_id), last_login_after and
+    last_login_before (ISO 8601 date or datetime).
+    """
+    queryset = User.objects.prefetch_related(*USER_RELATIONS)
+
+    if request.GET.get('status'):
+        queryset = queryset.filter(status=request.GET['status'])
+    if request.GET.get('group'):
+        queryset = queryset.filter(group__group_id=request.GET['group'])
+
+    last_login_after = get_datetime(request, 'last_login_after')
+    if last_login_after:
+        queryset = queryset.filter(last_login__gte=last_login_after)
+    last_login_before = get_datetime(request, 'last_login_before')
+    if last_login_before:
+        queryset = queryset.filter(last_login__lt=last_login_before)
+
+    return paginate(request, queryset, serialize_user)
+
+
+@require_GET
+@staff_member_required
+def export(request):
+    """Stream every Duo User with their groups, phones and tokens.
+
+    Parameters: format, csv (default) or ndjson, and gzip=1 for a
+    gzip compressed download.  Streamed responses are not cached.
+    """
+    format = request.GET.get('format', 'csv')
+    if format not in FORMATS:
+        return JsonResponse(
+            {'error': 'format must be one of %s' % ', '.join(FORMATS)},
+            status=400
+        )
+    compress = request.GET.get('gzip') in ('1', 'true')
+
+    filename = 'duo-users.%s' % format
+    if compress:
+        response = StreamingHttpResponse(
+            export_users(format, compress=True),
+            content_type='application/gzip'
+        )
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(
+            export_users(format), content_type=CONTENT_TYPES[format]
+        )
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+@read_api
+def search(request):
+    """Search Duo Users by partial username, email, real name or group.
+
+    Parameters: q, the search text, and limit.  Results are ranked
+    best match first.
+    """
+    limit = min(max(get_int(request, 'limit', SEARCH_LIMIT), 1),
+                MAX_SEARCH_LIMIT)
+    users = search_users(request.GET.get('q', ''), limit)
+    prefetch_related_objects(users, *USER_RELATIONS)
+
+    return JsonResponse({
+        'results': [serialize_user(user) for user in users],
+    })
+
+
+@read_api
+def groups(request):
+    """List Duo Groups with their number of Users.
+
+    Filters: status.
+    """
+    queryset = Group.objects.annotate(user_count=Count('users'))
+
+    if request.GET.get('status'):
+        queryset = queryset.filter(status=request.GET['status'])
+
+    return paginate(request, queryset, serialize_group)
+
+
+@read_api
+def phones(request):
+    """List Duo Phones with their Users.
+
+    Filters: user (user_id), platform, type.
+    """
+    queryset = Phone.objects.prefetch_related(BRIEF_USERS)
+
+    if request.GET.get('user'):
+        queryset = queryset.filter(users__user_id=request.GET['user'])
+    for field in ('platform', 'type'):
+        if request.GET.get(field):
+            queryset = queryset.filter(**{field: request.GET[field]})
+
+    return paginate(request, queryset, serialize_phone)
+
+
+@read_api
+def phone_lookup(request):
+    """Find Duo Phones and the Users owning them by phone number.
+
+    Parameters: number, either a full number in any format or at least
+    its last 4 digits.  Numbers starting with + or 00, or longer than a
+    national number, match on their E.164 form, others on their last
+    digits, so '(213) 555-0100' and '5550100' both find +12135550100.
+    """
+    number = request.GET.get('number', '').strip()
+    if len(digits(number)) < MIN_LOOKUP_DIGITS:
+        raise BadRequest(
+            'number must have at least %s digits' % MIN_LOOKUP_DIGITS
+        )
+
+    # One query, a range or equality scan of a Phone index joined to
+    # the through table and Users
+    pairs = Phone.users.through.objects.select_related('phone', 'user')
+    if number.startswith(('+', '00')) or len(digits(number)) > SUFFIX_DIGITS:
+        e164 = normalize_number(number)
+        if e164 is None:
+            # Filtering on None would match every unnormalized Phone
+            raise BadRequest('number is not a valid phone number')
+        pairs = pairs.filter(phone__e164=e164)
+    else:
+        low, high = suffix_range(number)
+        pairs = pairs.filter(
+            phone__number_suffix__gte=low, phone__number_suffix__lt=high
+        )
+
+    phones = {}
+    for pair in pairs[:LOOKUP_LIMIT]:
+        phone = phones.get(pair.phone_id)
+        if phone is None:
+            phone = phones[pair.phone_id] = {
+                'id': pair.phone.pk,
+                'phone_id': pair.phone.phone_id,
+                'number': pair.phone.number,
+                'e164': pair.phone.e164,
+                'extension': pair.phone.extension,
+                'type': pair.phone.type,
+                'platform': pair.phone.platform,
+                'users': [],
+            }
+        phone['users'].append(brief_user(pair.user))
+
+    return JsonResponse({'results': list(phones.values())})
+
+
+@read_api
+def tokens(request):
+    """List Duo Tokens with their Users.
+
+    Filters: user (user_id), type.
+    """
+    queryset = Token.objects.prefetch_related(BRIEF_USERS)
+
+    if request.GET.get('user'):
+        queryset = queryset.filter(users__user_id=request.GET['user'])
+    if request.GET.get('type'):
+        queryset = queryset.filter(type=request.GET['type'])
+
+    return paginate(request, queryset, serialize_token)
+
+
+@read_api
+def changes(request):
+    """List the change events emitted by syncs, oldest first.
+
+    Parameters: since, the last sync generation already read, and
+    after, the id of the last event already read.  Filters: kind,
+    user (user_id).
+    """
+    queryset = changes_since(get_int(request, 'since', 0))
+
+    if request.GET.get('kind'):
+        queryset = queryset.filter(kind=request.GET['kind'])
+    if request.GET.get('user'):
+        queryset = queryset.filter(user_id=request.GET['user'])
+
+    return paginate(request, queryset, serialize_event)
+
+
+@read_api
+def summary(request):
+    """Return the dashboard aggregates computed by the last sync."""
+    sync_run = last_sync(request)
+    return JsonResponse({
+        'summary': get_summary(),
+        'synced': sync_run and sync_run.finished,
+    })
@@ -29,6 +29,17 @@ DEBUG = True
 DUO_IKEY = os.getenv("DUO_IKEY")
 DUO_SKEY = os.getenv("DUO_SKEY")
 DUO_HOST = os.getenv("DUO_HOST")
+DUO_CA_CERTS = os.getenv("DUO_CA_CERTS")
+DUO_SYNC_METRICS_FILE = os.getenv("DUO_SYNC_METRICS_FILE")
+DUO_API_TIMEOUT = float(os.getenv("DUO_API_TIMEOUT", 30))
+DUO_API_POOL_SIZE = int(os.getenv("DUO_API_POOL_SIZE", 8))
+DUO_API_IDLE_TIMEOUT = float(os.getenv("DUO_API_IDLE_TIMEOUT", 60))
+DUO_CHANGE_RETENTION_DAYS = int(os.getenv("DUO_CHANGE_RETENTION_DAYS", 90))
+DUO_AUTHLOG_RETENTION_DAYS = int(os.getenv("DUO_AUTHLOG_RETENTION_DAYS", 30))
+DUO_PHONE_COUNTRY_CODE = os.getenv("DUO_PHONE_COUNTRY_CODE") or '1'
+DUO_SYNC_LOCK_FILE = (
+    os.getenv("DUO_SYNC_LOCK_FILE") or os.path.join(BASE_DIR, 'duo-sync.lock')
+)
 
 ALLOWED_HOSTS = []
 
@@ -87,6 +98,26 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+#
+# Cached responses are keyed on the sync generation, so they never
+# expire on their own; MAX_ENTRIES bounds the cache instead
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            "DUO_CACHE_BACKEND",
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv("DUO_CACHE_LOCATION", 'duo'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv("DUO_CACHE_MAX_ENTRIES", 1000)),
+        },
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 